@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import hashlib
+import threading
+from os.path import isfile, join
+
+from jsonfile import load_json, save_json
+
+
+def requirements_hash(worker_dir):
+    sha = hashlib.sha256()
+    path = join(worker_dir, 'requirements.txt')
+    if isfile(path):
+        with open(path, 'rb') as requirements:
+            sha.update(requirements.read())
+    return sha.hexdigest()
+
+
+class BaseImageCache:
+    """
+    Base images that succeeded or failed for each worker without Dockerfile,
+    persisted between runs. An entry is only used while the requirements.txt
+    of the worker is unchanged.
+
+    {
+        "<worker>": {"requirements": "<sha256>", "base": "python:3-slim",
+                     "failed": ["python:3-alpine"]}
+    }
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.entries = load_json(path, "Base image cache", {})
+
+    def entry(self, worker, requirements):
+        entry = self.entries.get(worker)
+        if entry is None or entry.get('requirements') != requirements:
+            return None
+        return entry
+
+    def order(self, worker, requirements, base_images):
+        """
+        Base images to try for a worker: the last known-good base first,
+        then the untried ones, then the ones that failed before.
+        """
+        with self.lock:
+            entry = self.entry(worker, requirements)
+            if entry is None:
+                self.misses += 1
+                return list(base_images)
+            self.hits += 1
+            failed = [base for base in base_images if base in entry.get('failed', [])]
+            good = [base for base in base_images if base == entry.get('base')]
+            others = [base for base in base_images if base not in failed and base not in good]
+            return good + others + failed
+
+    def record(self, worker, requirements, base, succeeded):
+        with self.lock:
+            entry = self.entry(worker, requirements)
+            if entry is None:
+                entry = self.entries[worker] = {'requirements': requirements, 'base': None, 'failed': []}
+            if succeeded:
+                entry['base'] = base
+                if base in entry['failed']:
+                    entry['failed'].remove(base)
+            else:
+                if entry['base'] == base:
+                    entry['base'] = None
+                if base not in entry['failed']:
+                    entry['failed'].append(base)
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            save_json(self.path, self.entries, indent=2, sort_keys=True)
+
+    def report(self):
+        print('Base image cache: {} hits, {} misses'.format(self.hits, self.misses))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import threading
+
+
+class BaseImages:
+    """
+    Base images of the generated Dockerfiles, pulled once per run and pinned
+    to the digest they resolved to: every worker of a run is built on the
+    same base, without a registry round trip per build.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.references = {}
+
+    def resolve(self, base):
+        """
+        Pull the base image on first use and return its pinned reference
+        (image:tag@sha256:...), or None if it can't be resolved.
+        """
+        with self.lock:
+            base_lock = self.locks.setdefault(base, threading.Lock())
+        with base_lock:
+            if base not in self.references:
+                try:
+                    print("Pulling base image {}".format(base))
+                    repository, tag = base.rsplit(':', 1)
+                    image = self.client.images.pull(repository, tag=tag)
+                    digests = [d for d in image.attrs.get('RepoDigests', []) if d.startswith(repository + '@')]
+                    self.references[base] = '{}@{}'.format(base, digests[0].split('@', 1)[1])
+                    print("Base image {} pinned to {}".format(base, self.references[base]))
+                except Exception as e:
+                    print("Can't resolve base image {}: {}".format(base, e))
+                    self.references[base] = None
+            return self.references[base]
+
+    def report(self):
+        for base, reference in sorted(self.references.items()):
+            print('Base image {}: {}'.format(base, reference or 'not resolved'))
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+
+import hashlib
+import io
+import json
+import re
+import tarfile
+import threading
+import time
+from collections import Counter
+from os.path import basename, isfile, join
+
+from docker.errors import ImageNotFound
+
+
+def split_reference(reference):
+    """
+    (repository, tag) of an image reference, tag defaulting to latest.
+    """
+    name, _, tag = reference.rpartition(':')
+    if not name or '/' in tag:
+        return reference, 'latest'
+    return name, tag
+
+
+def split_host(repository):
+    """
+    (registry host, namespace/repo) of a repository, host None for the
+    default registry.
+    """
+    first, _, rest = repository.partition('/')
+    if rest and ('.' in first or ':' in first):
+        return first, rest
+    return None, repository
+
+
+def wheel(requirement):
+    """
+    Compiled wheel built for a requirement line.
+    """
+    name = re.match(r'[A-Za-z0-9._-]+', requirement).group(0)
+    return '{}-1.0-cp312-cp312-linux_x86_64.whl'.format(re.sub(r'[-_.]+', '_', name).lower())
+
+
+def tar_archive(files):
+    """
+    Uncompressed tar archive of {name: bytes}, directories for None.
+    """
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            else:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return archive.getvalue()
+
+
+class FakeImage:
+
+    def __init__(self, client, image_id, labels, layers, repo_digests=None, wheels=None, requirements=None):
+        self.client = client
+        self.id = image_id
+        self.labels = labels
+        # wheels built in the image, in /wheels, and distributions installed
+        self.wheels = wheels or []
+        self.requirements = requirements or []
+        self.attrs = {
+            'Id': image_id,
+            'Size': 50 * 1024 * 1024 + 1024 * 1024 * len(layers),
+            'RootFS': {'Type': 'layers', 'Layers': layers},
+            'RepoDigests': repo_digests or [],
+            'Config': {'Env': ['PATH=/usr/local/bin:/usr/bin:/bin', 'PYTHON_VERSION=3.12.4']},
+        }
+
+    def tag(self, repository, tag=None):
+        self.client.api.tag(self.id, repository, tag)
+        return True
+
+    def save(self, chunk_size=None, named=False):
+        """
+        `docker save` archive: manifest, config with the labels and one
+        small layer per diff id.
+        """
+        self.client.count('save')
+        layers = self.attrs['RootFS']['Layers']
+        config = json.dumps({'config': {'Labels': self.labels},
+                             'rootfs': {'type': 'layers', 'diff_ids': layers}}, sort_keys=True).encode('utf-8')
+        files = {'{}.json'.format(self.id[7:]): config}
+        for layer in layers:
+            files['{}/layer.tar'.format(layer[7:])] = layer.encode('utf-8') * 256
+        files['manifest.json'] = json.dumps([{'Config': '{}.json'.format(self.id[7:]), 'RepoTags': None,
+                                             'Layers': ['{}/layer.tar'.format(layer[7:]) for layer in layers]}]
+                                           ).encode('utf-8')
+        yield tar_archive(files)
+
+
+class FakeImages:
+
+    def __init__(self, client):
+        self.client = client
+
+    def build(self, pull=False, labels=None, tag=None, path=None, fileobj=None, dockerfile=None, target=None,
+              **kwargs):
+        self.client.count('build')
+        time.sleep(self.client.build_latency)
+        labels = dict(labels or {})
+        sha = hashlib.sha256(json.dumps(labels, sort_keys=True).encode('utf-8'))
+        sha.update((tag or '').encode('utf-8'))
+        requirements = []
+        wheelhouse = None
+        if path is not None and dockerfile is not None:
+            with open(dockerfile, 'rb') as dockerfile_file:
+                sha.update(dockerfile_file.read())
+            if isfile(join(path, 'requirements.txt')):
+                with open(join(path, 'requirements.txt')) as requirements_file:
+                    requirements = requirements_file.read().split()
+        elif fileobj is not None:
+            # generated context: minimal context, or wheelhouse mode with the
+            # worker under worker/ and the wheels sent under wheelhouse/
+            with tarfile.open(fileobj=fileobj) as tar:
+                names = tar.getnames()
+                sha.update(tar.extractfile('Dockerfile').read())
+                for name in ('requirements.txt', 'worker/requirements.txt'):
+                    if name in names:
+                        requirements = tar.extractfile(name).read().decode('utf-8').split()
+                if 'wheelhouse' in names:
+                    wheelhouse = {basename(name) for name in names if name.startswith('wheelhouse/')}
+        layers = ['sha256:' + hashlib.sha256('{}{}'.format(sha.hexdigest(), i).encode('utf-8')).hexdigest()
+                  for i in range(4)]
+        wheels = [wheel(requirement) for requirement in requirements] if wheelhouse is not None else []
+        image = FakeImage(self.client, 'sha256:' + sha.hexdigest(), labels, layers, wheels=wheels,
+                          requirements=requirements)
+        self.client.store(image, tag)
+        output = [
+            {'stream': 'Step 1/4 : FROM base\n'},
+            {'stream': ' ---> Using cache\n'},
+            {'stream': 'Step 2/4 : COPY requirements.txt\n'},
+            {'stream': 'Step 3/4 : RUN pip install\n'},
+        ]
+        for requirement, built in zip(requirements, wheels):
+            # pip output of the wheels stage
+            if built in wheelhouse:
+                output.append({'stream': 'Processing /wheelhouse/{}\n'.format(built)})
+            else:
+                output.append({'stream': '  Building wheel for {} (setup.py): finished\n'.format(requirement)})
+        output += [
+            {'stream': 'Step 4/4 : COPY .\n'},
+            {'stream': 'Successfully built {}\n'.format(image.id[7:19])},
+        ]
+        return image, iter(output)
+
+    def get(self, name):
+        image = self.client.lookup(name)
+        if image is None:
+            raise ImageNotFound('No such image: {}'.format(name))
+        return image
+
+    def pull(self, repository, tag=None, auth_config=None, **kwargs):
+        self.client.count('pull')
+        time.sleep(self.client.pull_latency)
+        host, repo_full = split_host(repository)
+        if host is not None:
+            # images pulled from the stand-ins (shared layers) must exist there
+            state = self.client.states.get(host)
+            if state is None or state.resolve(repo_full, tag or 'latest') is None:
+                raise ImageNotFound('{}:{} not found'.format(repository, tag))
+        sha = hashlib.sha256('{}:{}'.format(repository, tag).encode('utf-8')).hexdigest()
+        image = FakeImage(self.client, 'sha256:' + sha, {}, ['sha256:' + sha],
+                          ['{}@sha256:{}'.format(repository, sha)])
+        self.client.store(image, '{}:{}'.format(repository, tag or 'latest'))
+        return image
+
+    def push(self, repository, tag=None, auth_config=None, stream=False, decode=False, **kwargs):
+        self.client.count('push')
+        time.sleep(self.client.push_latency)
+        image = self.get('{}:{}'.format(repository, tag or 'latest'))
+        host, repo_full = split_host(repository)
+        state = self.client.states[host]
+        layers = image.attrs['RootFS']['Layers']
+        existing = state.put_layers(layers)
+        digest = state.put_image(repo_full, tag or 'latest', image.labels, layers)
+        events = [{'status': 'The push refers to repository [{}]'.format(repository)}]
+        for layer in layers:
+            layer_id = layer[7:19]
+            events.append({'status': 'Preparing', 'progressDetail': {}, 'id': layer_id})
+            if layer in existing:
+                events.append({'status': 'Layer already exists', 'progressDetail': {}, 'id': layer_id})
+                continue
+            for current in (512 * 1024, 1024 * 1024):
+                events.append({'status': 'Pushing', 'progressDetail': {'current': current, 'total': 1024 * 1024},
+                               'id': layer_id})
+            events.append({'status': 'Pushed', 'progressDetail': {}, 'id': layer_id})
+        events.append({'status': '{}: digest: {} size: 1024'.format(tag, digest)})
+        events.append({'progressDetail': {}, 'aux': {'Tag': tag, 'Digest': digest, 'Size': 1024}})
+        if stream:
+            return iter(events) if decode else (json.dumps(event).encode('utf-8') + b'\r\n' for event in events)
+        return ''.join(json.dumps(event) + '\r\n' for event in events)
+
+    def remove(self, image, **kwargs):
+        self.client.unstore(image)
+
+
+class FakeContainer:
+
+    def __init__(self, client, image=None):
+        self.client = client
+        self.image = image
+
+    def wait(self, timeout=None, **kwargs):
+        time.sleep(self.client.import_test_latency)
+        return {'StatusCode': 0}
+
+    def logs(self, stdout=True, stderr=True, **kwargs):
+        # output of both the import test and the startup measure
+        now = time.time()
+        output = {'failed': {}, 'started': now, 'first_import': now, 'imports': now}
+        return (json.dumps(output) + '\n').encode('utf-8') if stdout else b''
+
+    def get_archive(self, path, **kwargs):
+        """
+        Archive of a directory of the image: the wheels built in it for
+        /wheels, the *.dist-info of the requirements for site-packages (lxml
+        being compiled), empty otherwise.
+        """
+        name = basename(path.rstrip('/'))
+        files = {name: None}
+        if path.rstrip('/') == '/wheels':
+            files.update({'{}/{}'.format(name, built): b'wheel' for built in self.image.wheels})
+        elif name == 'site-packages':
+            for requirement in self.image.requirements:
+                distribution = re.sub(r'[-_.]+', '_', requirement).lower()
+                dist_info = '{}/{}-1.0.dist-info/'.format(name, distribution)
+                purelib = 'false' if distribution == 'lxml' else 'true'
+                files[dist_info + 'WHEEL'] = 'Wheel-Version: 1.0\nRoot-Is-Purelib: {}\n'.format(purelib).encode()
+                files[dist_info + 'top_level.txt'] = (distribution + '\n').encode()
+        return iter([tar_archive(files)]), {'name': name, 'size': 0}
+
+    def kill(self, **kwargs):
+        pass
+
+    def remove(self, **kwargs):
+        pass
+
+
+class FakeContainers:
+    """
+    Containers of the import tests and startup measures: they take the
+    configured time and every import succeeds. Containers created (not
+    started) give the files of their image, e.g. the wheels of the
+    wheelhouse mode.
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def run(self, image, command=None, **kwargs):
+        self.client.count('import_test')
+        return FakeContainer(self.client, self.client.images.get(image))
+
+    def create(self, image, command=None, **kwargs):
+        self.client.count('create')
+        return FakeContainer(self.client, self.client.images.get(image))
+
+
+class FakeAPI:
+
+    def __init__(self, client):
+        self.client = client
+
+    def tag(self, image, repository, tag=None, **kwargs):
+        source = self.client.lookup(image)
+        if source is None:
+            raise ImageNotFound('No such image: {}'.format(image))
+        self.client.store(source, repository if tag is None else '{}:{}'.format(repository, tag))
+        return True
+
+
+class FakeDockerClient:
+    """
+    Stand-in for docker.DockerClient: builds, pulls and pushes take the
+    configured time and images pushed to a registry host are stored in the
+    RegistryState of that host (None for Docker Hub), so that the next run
+    finds their labels through the registry APIs.
+    """
+
+    def __init__(self, states, build_latency=0.0, push_latency=0.0, pull_latency=0.0, import_test_latency=0.0):
+        self.states = states
+        self.build_latency = build_latency
+        self.push_latency = push_latency
+        self.pull_latency = pull_latency
+        self.import_test_latency = import_test_latency
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self.references = {}
+        self.images = FakeImages(self)
+        self.api = FakeAPI(self)
+        self.containers = FakeContainers(self)
+
+    def count(self, operation):
+        with self.lock:
+            self.stats[operation] += 1
+
+    def reset(self):
+        with self.lock:
+            stats = Counter(self.stats)
+            self.stats.clear()
+        return stats
+
+    def store(self, image, reference):
+        with self.lock:
+            self.references['{}:{}'.format(*split_reference(reference))] = image
+
+    def unstore(self, reference):
+        with self.lock:
+            self.references.pop('{}:{}'.format(*split_reference(reference)), None)
+
+    def lookup(self, reference):
+        with self.lock:
+            if reference.startswith('sha256:'):
+                return next((image for image in self.references.values() if image.id == reference), None)
+            return self.references.get('{}:{}'.format(*split_reference(reference)))
+
+    def login(self, username=None, password=None, registry=None, **kwargs):
+        return {'Status': 'Login Succeeded'}
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the builder against a synthetic Cortex-Analyzers style
+repository, a fake Docker client and local stand-ins for Docker Hub and
+Harbor: no Docker daemon nor registry credentials needed.
+
+Runs, in order, on the same repository and registries:
+  initial       first build of every flavor (empty registries)
+  no-change     nothing changed since the previous run
+  small-change  one worker modified and committed
+  force         --force run, every flavor rebuilt and pushed
+
+and reports, for each run, the wall time, the Docker operations and the
+HTTP requests made to each registry. Results can be appended to a JSON
+lines file (--output) to compare scheduler and caching changes over time.
+Runs with failures (failed builds or pushes, wheelhouse not updated) are
+reported as errors and the benchmark exits with status 1.
+
+    python benchmarks/run.py --workers 50 --flavors 2 -j 4 --build-latency 0.2
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import shutil
+import sys
+import tempfile
+import time
+from os import makedirs
+from os.path import abspath, dirname, join
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+import git  # noqa: E402
+
+import build  # noqa: E402
+from dockerhub import Dockerhub  # noqa: E402
+from harbor import Harbor  # noqa: E402
+from fakedocker import FakeDockerClient  # noqa: E402
+from standin import RegistryState, StandIn  # noqa: E402
+
+NAMESPACE = "cortexneurons"
+REQUIREMENTS = ["cortexutils", "requests", "python-dateutil", "pyyaml", "dnspython", "urllib3", "beautifulsoup4",
+                "lxml", "pytz", "ipaddress"]
+
+
+def create_repository(path, workers, flavors):
+    """
+    Git repository with analyzers/<Worker>/ directories, each with an
+    entrypoint, a requirements.txt and its flavor JSON files.
+    """
+    repo = git.Repo.init(path)
+    for i in range(workers):
+        name = 'Worker{:03d}'.format(i)
+        worker_dir = join(path, 'analyzers', name)
+        makedirs(worker_dir)
+        with open(join(worker_dir, '{}.py'.format(name.lower())), 'w') as entrypoint:
+            entrypoint.write('#!/usr/bin/env python3\nimport requests\nfrom cortexutils.analyzer import Analyzer\n')
+        with open(join(worker_dir, 'requirements.txt'), 'w') as requirements:
+            requirements.write('\n'.join(REQUIREMENTS[j % len(REQUIREMENTS)] for j in range(i % 4 + 1)) + '\n')
+        for j in range(flavors):
+            with open(join(worker_dir, '{}_{}.json'.format(name, j + 1)), 'w') as flavor:
+                json.dump({
+                    'name': '{}_{}'.format(name, j + 1),
+                    'version': '1.{}'.format(j),
+                    'author': 'Benchmark',
+                    'license': 'AGPL-V3',
+                    'description': 'Synthetic flavor {} of {}'.format(j + 1, name),
+                    'dataTypeList': ['ip', 'domain'],
+                    'command': '{}/{}.py'.format(name, name.lower()),
+                    'baseConfig': name,
+                }, flavor, indent=2)
+    repo.git.add(A=True)
+    repo.index.commit('Synthetic workers')
+    return repo
+
+
+def small_change(repo, path):
+    with open(join(path, 'analyzers', 'Worker000', 'worker000.py'), 'a') as entrypoint:
+        entrypoint.write('# changed\n')
+    repo.git.add(A=True)
+    repo.index.commit('Small change')
+
+
+def run(options, scenario, path, client, hub, harbor, force=False):
+    argv = ['--namespace', NAMESPACE, '--base-path', path, '--path', 'analyzers', '--jobs', str(options.jobs),
+            '--cache-dir', join(path, '.neurons-builder'), '--log-dir', join(options.workdir, 'logs', scenario),
+            '--report', join(options.workdir, 'reports', '{}.jsonl'.format(scenario))]
+    if options.push_jobs:
+        argv += ['--push-jobs', str(options.push_jobs)]
+    if force:
+        argv.append('--force')
+    args = build.parse_args(argv + options.builder_args)
+    args.docker_client = client
+    dockerhub = Dockerhub(client, 'user:password@{}'.format(hub.host))
+    dockerhub.scheme = 'http'
+    dockerhub.hub_api = 'http://{}/hub'.format(hub.host)
+    harbor_registry = Harbor(client, 'user:password@{}'.format(harbor.host))
+    harbor_registry.scheme = 'http'
+    args.registry = [dockerhub, harbor_registry]
+    if args.push_jobs is None:
+        args.push_jobs = args.jobs * len(args.registry)
+    args.workers = [join('analyzers', 'Worker{:03d}'.format(i)) for i in range(options.workers)]
+
+    client.reset()
+    hub.reset()
+    harbor.reset()
+    list_summary = [[], [], []]
+    with open(join(options.workdir, '{}.log'.format(scenario)), 'w') as log:
+        with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+            start = time.monotonic()
+            build.build_workers(args, list_summary)
+            wall_time = time.monotonic() - start
+    # failed builds and pushes, and failures the builder works around (the
+    # wheelhouse not updated...): the run can't be compared
+    errors = list(list_summary[2])
+    errors += ['{}: wheelhouse update failed: {}'.format(record['name'], record['wheelhouse']['error'])
+               for record in args.report.records()
+               if record.get('type') == 'flavor' and (record.get('wheelhouse') or {}).get('error')]
+    return {
+        'scenario': scenario,
+        'wall_time': round(wall_time, 3),
+        'errors': errors,
+        'skipped': len(list_summary[0]),
+        'succeeded': len(list_summary[1]),
+        'failed': len(list_summary[2]),
+        'docker': dict(client.reset()),
+        'requests': {'dockerhub': dict(hub.reset()), 'harbor': dict(harbor.reset())},
+    }
+
+
+def display(results):
+    print('{:<14}{:>10}{:>9}{:>9}{:>8}{:>8}{:>8}{:>11}{:>9}'.format(
+        'scenario', 'wall (s)', 'skipped', 'pushed', 'failed', 'builds', 'pushes', 'dockerhub', 'harbor'))
+    for result in results:
+        print('{:<14}{:>10.2f}{:>9}{:>9}{:>8}{:>8}{:>8}{:>11}{:>9}'.format(
+            result['scenario'], result['wall_time'], result['skipped'], result['succeeded'], result['failed'],
+            result['docker'].get('build', 0), result['docker'].get('push', 0),
+            sum(result['requests']['dockerhub'].values()), sum(result['requests']['harbor'].values())))
+    for result in results:
+        for error in result['errors']:
+            print('ERROR {}: {}'.format(result['scenario'], error))
+    if results:
+        print()
+        print('HTTP requests per route:')
+        for result in results:
+            print('  {}'.format(result['scenario']))
+            for registry, requests in sorted(result['requests'].items()):
+                for route, count in sorted(requests.items()):
+                    print('    {:<10} {:>6}  {}'.format(registry, count, route))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the builder with a fake Docker client and local '
+                                                 'registry stand-ins')
+    parser.add_argument('--workers', type=int, default=20, help='Number of synthetic workers')
+    parser.add_argument('--flavors', type=int, default=2, help='Number of flavors per worker')
+    parser.add_argument('-j', '--jobs', type=int, default=4, help='Number of workers built in parallel')
+    parser.add_argument('--push-jobs', type=int, help='Number of images pushed in parallel')
+    parser.add_argument('--build-latency', type=float, default=0.1, help='Duration of a build, in seconds')
+    parser.add_argument('--push-latency', type=float, default=0.05, help='Duration of a push, in seconds')
+    parser.add_argument('--pull-latency', type=float, default=0.05, help='Duration of a pull, in seconds')
+    parser.add_argument('--import-test-latency', type=float, default=0.5,
+                        help='Duration of an import test container, in seconds')
+    parser.add_argument('--http-latency', type=float, default=0.005,
+                        help='Round trip added to each HTTP request, in seconds')
+    parser.add_argument('--output', help='Append the results to this JSON lines file')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory (logs, reports)')
+    parser.add_argument('builder_args', nargs='*',
+                        help='Extra options of build.py, after --, e.g. -- --shared-layers 3')
+    options = parser.parse_args()
+    options.workdir = tempfile.mkdtemp(prefix='neurons-benchmark-')
+    path = join(options.workdir, 'repository')
+
+    hub_state, harbor_state = RegistryState(), RegistryState()
+    hub = StandIn('dockerhub', hub_state, options.http_latency).start()
+    harbor = StandIn('harbor', harbor_state, options.http_latency).start()
+    client = FakeDockerClient({None: hub_state, harbor.host: harbor_state}, options.build_latency,
+                              options.push_latency, options.pull_latency, options.import_test_latency)
+
+    results = []
+    try:
+        repo = create_repository(path, options.workers, options.flavors)
+        results.append(run(options, 'initial', path, client, hub, harbor))
+        results.append(run(options, 'no-change', path, client, hub, harbor))
+        small_change(repo, path)
+        results.append(run(options, 'small-change', path, client, hub, harbor))
+        results.append(run(options, 'force', path, client, hub, harbor, force=True))
+    finally:
+        hub.stop()
+        harbor.stop()
+        display(results)
+        if options.output:
+            with open(options.output, 'a') as output:
+                output.write(json.dumps({
+                    'date': datetime.datetime.now().isoformat('T') + 'Z',
+                    'commit': git.Repo(dirname(dirname(abspath(__file__))), search_parent_directories=True)
+                    .head.commit.hexsha,
+                    'options': {key: value for key, value in vars(options).items() if key != 'workdir'},
+                    'results': results,
+                }, sort_keys=True) + '\n')
+        if options.keep:
+            print('Working directory: {}'.format(options.workdir))
+        else:
+            shutil.rmtree(options.workdir, ignore_errors=True)
+    if any(result['errors'] for result in results):
+        print('Benchmark failed: runs with errors, see the scenario logs (--keep)')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+MANIFEST_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+CONFIG_TYPE = "application/vnd.docker.container.image.v1+json"
+LAYER_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+
+
+def digest(data):
+    return 'sha256:' + hashlib.sha256(data).hexdigest()
+
+
+class RegistryState:
+    """
+    Images of a registry: manifests and blobs by digest, and the tags of
+    each repository (namespace/repo).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.manifests = {}
+        self.blobs = {}
+        self.tags = {}
+
+    def put_image(self, repo_full, tag, labels, layers):
+        """
+        Store an image pushed by the fake Docker client, return its manifest
+        digest.
+        """
+        config = json.dumps({'config': {'Labels': labels},
+                             'rootfs': {'type': 'layers', 'diff_ids': layers}}, sort_keys=True).encode('utf-8')
+        manifest = json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_TYPE,
+            'config': {'mediaType': CONFIG_TYPE, 'size': len(config), 'digest': digest(config)},
+            'layers': [{'mediaType': LAYER_TYPE, 'size': 1024, 'digest': layer} for layer in layers],
+        }, sort_keys=True).encode('utf-8')
+        with self.lock:
+            self.blobs[digest(config)] = config
+        return self.put_manifest(repo_full, tag, manifest)
+
+    def put_layers(self, layers):
+        """
+        Store the layers of a pushed image, return the ones already there.
+        """
+        with self.lock:
+            existing = {layer for layer in layers if layer in self.blobs}
+            for layer in layers:
+                self.blobs.setdefault(layer, b'')
+            return existing
+
+    def put_manifest(self, repo_full, tag, manifest):
+        with self.lock:
+            self.manifests[digest(manifest)] = manifest
+            self.tags.setdefault(repo_full, {})[tag] = digest(manifest)
+            return digest(manifest)
+
+    def resolve(self, repo_full, reference):
+        with self.lock:
+            if reference.startswith('sha256:'):
+                return reference if reference in self.manifests else None
+            return self.tags.get(repo_full, {}).get(reference)
+
+    def labels(self, manifest_digest):
+        with self.lock:
+            config_digest = json.loads(self.manifests[manifest_digest])['config']['digest']
+            return json.loads(self.blobs[config_digest])['config']['Labels']
+
+    def artifacts(self, repo_full):
+        """
+        Artifacts of a repository as listed by the Harbor API: one per
+        manifest, with its tags.
+        """
+        with self.lock:
+            tags = dict(self.tags.get(repo_full, {}))
+        by_digest = {}
+        for tag, manifest_digest in sorted(tags.items()):
+            by_digest.setdefault(manifest_digest, []).append({'name': tag})
+        return [{'digest': manifest_digest, 'tags': tags,
+                 'extra_attrs': {'config': {'Labels': self.labels(manifest_digest)}}}
+                for manifest_digest, tags in sorted(by_digest.items())]
+
+
+class StandIn:
+    """
+    Local HTTP server standing in for a registry: the registry v2 API
+    (bearer token challenge, manifests, blobs and blob uploads) and, depending on kind,
+    the Docker Hub tags API (under /hub) or the Harbor v2.0 artifacts API.
+    Requests are counted per route, and each one can be delayed to simulate
+    the network round trip.
+    """
+
+    def __init__(self, kind, state, latency=0.0):
+        self.kind = kind
+        self.state = state
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.requests = Counter()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def host(self):
+        return '{}:{}'.format(*self.server.server_address)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset(self):
+        with self.lock:
+            requests = Counter(self.requests)
+            self.requests.clear()
+        return requests
+
+    def routes(self):
+        routes = [
+            ('GET', r'/v2/', self.challenge),
+            ('GET', r'/token', self.token),
+            ('GET', r'/v2/(?P<repo>.+)/manifests/(?P<reference>[^/]+)', self.get_manifest),
+            ('HEAD', r'/v2/(?P<repo>.+)/manifests/(?P<reference>[^/]+)', self.get_manifest),
+            ('PUT', r'/v2/(?P<repo>.+)/manifests/(?P<reference>[^/]+)', self.put_manifest),
+            ('GET', r'/v2/(?P<repo>.+)/blobs/(?P<digest>sha256:[^/]+)', self.get_blob),
+            ('HEAD', r'/v2/(?P<repo>.+)/blobs/(?P<digest>sha256:[^/]+)', self.get_blob),
+            ('POST', r'/v2/(?P<repo>.+)/blobs/uploads/', self.start_upload),
+            ('PUT', r'/v2/(?P<repo>.+)/blobs/uploads/(?P<upload>[^/]+)', self.end_upload),
+        ]
+        if self.kind == 'dockerhub':
+            routes.append(('GET', r'/hub/v2/repositories/(?P<repo>.+)/tags/(?P<tag>[^/]+)', self.hub_tag))
+        else:
+            project = r'/api/v2\.0/projects/(?P<project>[^/]+)'
+            artifacts = project + r'/repositories/(?P<repo>[^/]+)/artifacts'
+            routes += [
+                ('GET', project + r'/repositories', self.harbor_repositories),
+                ('GET', artifacts, self.harbor_artifacts),
+                ('GET', artifacts + r'/(?P<reference>[^/]+)', self.harbor_artifact),
+                ('POST', artifacts + r'/(?P<reference>[^/]+)/tags', self.harbor_add_tag),
+                ('DELETE', artifacts + r'/(?P<reference>[^/]+)/tags/(?P<tag>[^/]+)', self.harbor_delete_tag),
+            ]
+        # requests are counted per route, e.g. "GET /v2/<repo>/manifests/<reference>"
+        return [(method, re.compile('^{}$'.format(pattern)),
+                 re.sub(r'\(\?P<(\w+)>[^)]*\)', r'<\1>', pattern).replace('\\', ''), route)
+                for method, pattern, route in routes]
+
+    def handler(self):
+        standin = self
+        routes = self.routes()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def dispatch(self):
+                url = urlsplit(self.path)
+                if self.headers.get('Transfer-Encoding') == 'chunked':
+                    # blobs uploaded by the blob push engine
+                    body = b''
+                    while True:
+                        size = int(self.rfile.readline().split(b';', 1)[0], 16)
+                        chunk = self.rfile.read(size + 2)
+                        if not size:
+                            break
+                        body += chunk[:-2]
+                else:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    body = self.rfile.read(length) if length else b''
+                if standin.latency:
+                    time.sleep(standin.latency)
+                for method, regex, name, route in routes:
+                    match = regex.match(url.path)
+                    if method == self.command and match:
+                        with standin.lock:
+                            standin.requests['{} {}'.format(method, name)] += 1
+                        status, headers, data = route(parse_qs(url.query), body, self.headers, **match.groupdict())
+                        break
+                else:
+                    with standin.lock:
+                        standin.requests['{} (unknown)'.format(self.command)] += 1
+                    status, headers, data = 404, {}, b'{"errors": [{"code": "NOT_FOUND"}]}'
+                self.send_response(status)
+                headers.setdefault('Content-Type', 'application/json')
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+
+            do_GET = do_HEAD = do_PUT = do_POST = do_DELETE = dispatch
+
+        return Handler
+
+    def json(self, status, value, headers=None):
+        return status, headers or {}, json.dumps(value).encode('utf-8')
+
+    def not_found(self):
+        return self.json(404, {'errors': [{'code': 'NOT_FOUND'}]})
+
+    # registry v2 API
+
+    def challenge(self, query, body, headers):
+        realm = 'http://{}/token'.format(self.host)
+        return self.json(401, {'errors': [{'code': 'UNAUTHORIZED'}]},
+                         {'WWW-Authenticate': 'Bearer realm="{}",service="standin"'.format(realm)})
+
+    def token(self, query, body, headers):
+        return self.json(200, {'token': 'standin-token', 'expires_in': 300})
+
+    def get_manifest(self, query, body, headers, repo, reference):
+        manifest_digest = self.state.resolve(repo, reference)
+        if manifest_digest is None:
+            return self.not_found()
+        return 200, {'Content-Type': MANIFEST_TYPE, 'Docker-Content-Digest': manifest_digest}, \
+            self.state.manifests[manifest_digest]
+
+    def put_manifest(self, query, body, headers, repo, reference):
+        manifest_digest = self.state.put_manifest(repo, reference, body)
+        return 201, {'Docker-Content-Digest': manifest_digest}, b''
+
+    def get_blob(self, query, body, headers, repo, digest):
+        if digest not in self.state.blobs:
+            return self.not_found()
+        return 200, {'Content-Type': 'application/octet-stream'}, self.state.blobs[digest]
+
+    def start_upload(self, query, body, headers, repo):
+        mounted = query.get('mount', [None])[0]
+        if mounted is not None and mounted in self.state.blobs:
+            return 201, {'Docker-Content-Digest': mounted}, b''
+        location = '/v2/{}/blobs/uploads/{}'.format(repo, uuid.uuid4().hex)
+        return 202, {'Location': location}, b''
+
+    def end_upload(self, query, body, headers, repo, upload):
+        blob_digest = query['digest'][0]
+        with self.state.lock:
+            self.state.blobs[blob_digest] = body
+        return 201, {'Docker-Content-Digest': blob_digest}, b''
+
+    # Docker Hub API
+
+    def hub_tag(self, query, body, headers, repo, tag):
+        manifest_digest = self.state.resolve(repo, tag)
+        if manifest_digest is None:
+            return self.json(404, {'message': 'tag not found'})
+        return self.json(200, {
+            'name': tag,
+            'last_updated': '2024-01-01T00:00:00Z',
+            'tag_last_pushed': '2024-01-01T00:00:00Z',
+            'images': [{'digest': manifest_digest, 'status': 'active', 'last_pushed': '2024-01-01T00:00:00Z'}],
+        })
+
+    # Harbor v2.0 API
+
+    def page(self, query, items):
+        page = int(query.get('page', ['1'])[0])
+        page_size = int(query.get('page_size', ['10'])[0])
+        return items[(page - 1) * page_size:page * page_size]
+
+    def harbor_repositories(self, query, body, headers, project):
+        with self.state.lock:
+            repos = sorted(repo for repo in self.state.tags if repo.startswith(project + '/'))
+        return self.json(200, self.page(query, [{'name': repo} for repo in repos]))
+
+    def harbor_artifacts(self, query, body, headers, project, repo):
+        artifacts = self.state.artifacts('{}/{}'.format(project, repo))
+        tag_query = query.get('q', [''])[0]
+        if tag_query.startswith('tags='):
+            tag = tag_query[len('tags='):]
+            artifacts = [a for a in artifacts if any(t['name'] == tag for t in a['tags'])]
+        return self.json(200, self.page(query, artifacts))
+
+    def harbor_artifact(self, query, body, headers, project, repo, reference):
+        manifest_digest = self.state.resolve('{}/{}'.format(project, repo), reference)
+        if manifest_digest is None:
+            return self.json(404, {'errors': [{'code': 'NOT_FOUND'}]})
+        artifacts = self.state.artifacts('{}/{}'.format(project, repo))
+        return self.json(200, [a for a in artifacts if a['digest'] == manifest_digest][0])
+
+    def harbor_add_tag(self, query, body, headers, project, repo, reference):
+        repo_full = '{}/{}'.format(project, repo)
+        manifest_digest = self.state.resolve(repo_full, reference)
+        if manifest_digest is None:
+            return self.not_found()
+        tag = json.loads(body)['name']
+        with self.state.lock:
+            tags = self.state.tags.setdefault(repo_full, {})
+            if tag in tags:
+                return self.json(409, {'errors': [{'code': 'CONFLICT'}]})
+            tags[tag] = manifest_digest
+        return self.json(201, {})
+
+    def harbor_delete_tag(self, query, body, headers, project, repo, reference, tag):
+        repo_full = '{}/{}'.format(project, repo)
+        with self.state.lock:
+            tags = self.state.tags.get(repo_full, {})
+            if tag not in tags:
+                return self.not_found()
+            del tags[tag]
+        return self.json(200, {})
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import gzip
+import hashlib
+import json
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os import remove
+
+import requests
+from dxf import DXF
+from dxf.exceptions import DXFMountFailed
+
+from jsonfile import load_json, save_json
+
+MANIFEST_TYPE = "application/vnd.docker.distribution.manifest.v2+json"
+CONFIG_TYPE = "application/vnd.docker.container.image.v1+json"
+LAYER_TYPE = "application/vnd.docker.image.rootfs.diff.tar.gzip"
+CHUNK_SIZE = 1024 * 1024
+# Bytes of compressed layers kept for the next images once no image being
+# pushed uses them (base layers...), the least recently used removed first
+BLOB_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+
+
+class ExportedImage:
+    """
+    Local image exported with `docker save`: its config and its layers,
+    compressed by the given function.
+    """
+
+    def __init__(self, client, image, compress):
+        with tempfile.TemporaryFile() as archive:
+            for chunk in client.images.get(image).save():
+                archive.write(chunk)
+            archive.seek(0)
+            with tarfile.open(fileobj=archive) as tar:
+                manifest = json.load(tar.extractfile('manifest.json'))[0]
+                self.config = tar.extractfile(manifest['Config']).read()
+                self.diff_ids = json.loads(self.config)['rootfs']['diff_ids']
+                self.layers = [compress(diff_id, tar.extractfile(layer))
+                               for diff_id, layer in zip(self.diff_ids, manifest['Layers'])]
+
+    def manifest(self):
+        return json.dumps({
+            'schemaVersion': 2,
+            'mediaType': MANIFEST_TYPE,
+            'config': {
+                'mediaType': CONFIG_TYPE,
+                'size': len(self.config),
+                'digest': 'sha256:' + hashlib.sha256(self.config).hexdigest(),
+            },
+            'layers': [{'mediaType': LAYER_TYPE, 'size': layer['size'], 'digest': layer['digest']}
+                       for layer in self.layers],
+        }, sort_keys=True)
+
+
+class BlobPusher:
+    """
+    Push engine talking to the registry v2 API with DXF instead of the Docker
+    daemon. Layers already pushed to another repository of the namespace are
+    mounted (POST /blobs/uploads/?mount=&from=) instead of uploaded, and the
+    remaining layers are uploaded concurrently.
+
+    The repository known to hold each blob is remembered per registry in
+    blobs.json, so mounts also work across runs.
+
+    Compressed layers are kept in a temporary directory. Once all the pushes
+    announced for an image are done (see expect), the image is dropped and
+    its layers no other image being pushed uses become idle: the idle
+    layers are kept for the next images up to cache_size bytes, the least
+    recently used being removed first.
+    """
+
+    def __init__(self, client, cache_path=None, jobs=4, cache_size=BLOB_CACHE_SIZE):
+        self.client = client
+        self.cache_path = cache_path
+        self.jobs = jobs
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.image_locks = {}
+        self.images = {}
+        self.layers = {}
+        # exported images (not done) using each layer, pushes left for each
+        # image and idle layers (diff_id -> size) in least recently used order
+        self.users = {}
+        self.pending = {}
+        self.idle = OrderedDict()
+        self.idle_size = 0
+        self.directory = tempfile.mkdtemp(prefix='neurons-push-')
+        self.blobs = load_json(cache_path, "Blob cache", {})
+        self.stats = {'mounted': 0, 'uploaded': 0, 'existing': 0}
+
+    def compress(self, diff_id, layer):
+        """
+        Compress a layer deterministically (gzip level 6, no timestamp): the
+        same layer always gives the same blob digest, in every repository and
+        every run. Layers shared by several images are compressed once, as
+        long as they are not removed from the idle layers.
+        """
+        with self.lock:
+            self.users[diff_id] = self.users.get(diff_id, 0) + 1
+            if diff_id in self.idle:
+                self.idle_size -= self.idle.pop(diff_id)
+            if diff_id in self.layers:
+                return self.layers[diff_id]
+        sha = hashlib.sha256()
+        compressed = tempfile.NamedTemporaryFile(dir=self.directory, delete=False)
+        with compressed:
+            with gzip.GzipFile(filename='', mode='wb', compresslevel=6, mtime=0, fileobj=compressed) as gz:
+                shutil.copyfileobj(layer, gz, CHUNK_SIZE)
+        with open(compressed.name, 'rb') as blob:
+            for chunk in iter(lambda: blob.read(CHUNK_SIZE), b''):
+                sha.update(chunk)
+            size = blob.tell()
+        with self.lock:
+            layer = self.layers.setdefault(diff_id, {'digest': 'sha256:' + sha.hexdigest(), 'size': size,
+                                                     'path': compressed.name})
+        if layer['path'] != compressed.name:
+            # compressed at the same time for another image
+            remove(compressed.name)
+        return layer
+
+    def exported(self, image):
+        with self.lock:
+            image_lock = self.image_locks.setdefault(image, threading.Lock())
+        with image_lock:
+            if image not in self.images:
+                self.images[image] = ExportedImage(self.client, image, self.compress)
+            return self.images[image]
+
+    def expect(self, image, pushes):
+        """
+        Announce pushes (calls to done) of the local image, before the first
+        one starts.
+        """
+        with self.lock:
+            self.pending[image] = self.pending.get(image, 0) + pushes
+
+    def done(self, image):
+        """
+        A push of image is done: when it is the last one, drop its export.
+        Its layers no other image uses become idle, and the least recently
+        used idle layers are removed while they take more than cache_size.
+        """
+        with self.lock:
+            self.pending[image] -= 1
+            if self.pending[image] > 0:
+                return
+            del self.pending[image]
+            exported = self.images.pop(image, None)
+            if exported is None:
+                return
+            for diff_id in exported.diff_ids:
+                self.users[diff_id] -= 1
+                if self.users[diff_id] == 0:
+                    del self.users[diff_id]
+                    self.idle[diff_id] = self.layers[diff_id]['size']
+                    self.idle_size += self.idle[diff_id]
+            while self.idle_size > self.cache_size:
+                diff_id, size = self.idle.popitem(last=False)
+                self.idle_size -= size
+                remove(self.layers.pop(diff_id)['path'])
+
+    def dxf(self, registry, repo_full):
+        def auth(_dxf, response):
+            # token for the scopes asked by the registry (a mount also needs
+            # pull on the source repository), from the registry token cache
+            challenge = response.headers.get('www-authenticate', '')
+            scopes = re.findall(r'scope="([^"]*)"', challenge)
+            scopes = scopes[0].split(' ') if scopes else ['repository:{}:pull,push'.format(repo_full)]
+            token = registry.bearer_token(scopes)
+            if token is None:
+                _dxf.authenticate(username=registry.username, password=registry.password, response=response)
+            else:
+                _dxf.token = token
+
+        dxf = DXF(host=registry.registry, repo=repo_full, auth=auth, insecure=registry.scheme == 'http')
+        # keep-alive session of the registry
+        dxf._sessions = [registry.http]
+        return dxf
+
+    def blob_exists(self, dxf, digest):
+        try:
+            dxf.blob_size(digest)
+            return True
+        except requests.exceptions.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return False
+            raise
+
+    def push_blob(self, registry, dxf, namespace, repo_full, layer):
+        known = self.blobs.setdefault(registry.registry, {})
+        source = known.get(layer['digest'])
+        if source is not None and source != repo_full and source.startswith(namespace + '/'):
+            try:
+                dxf.mount_blob(source, layer['digest'])
+                return 'mounted'
+            except DXFMountFailed:
+                pass
+            except Exception as e:
+                print('Mount of {} from {} failed: {}'.format(layer['digest'], source, e))
+        if self.blob_exists(dxf, layer['digest']):
+            result = 'existing'
+        else:
+            def chunks():
+                with open(layer['path'], 'rb') as blob:
+                    yield from iter(lambda: blob.read(CHUNK_SIZE), b'')
+            dxf.push_blob(data=chunks(), digest=layer['digest'], check_exists=False)
+            result = 'uploaded'
+        with self.lock:
+            known[layer['digest']] = repo_full
+        return result
+
+    def push(self, registry, namespace, repo, tag, source=None):
+        """
+        Push the local image source (default namespace/repo) as
+        namespace/repo:tag and return the manifest digest.
+        """
+        repo_full = '{}/{}'.format(namespace, repo)
+        image = self.exported(source or repo_full)
+        print('Pushing {}:{} with the blob push engine ({})'.format(repo_full, tag, registry.name()))
+        dxf = self.dxf(registry, repo_full)
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            results = list(pool.map(lambda layer: self.push_blob(registry, dxf, namespace, repo_full, layer),
+                                    image.layers))
+        dxf.push_blob(data=iter([image.config]), digest='sha256:' + hashlib.sha256(image.config).hexdigest())
+        manifest = image.manifest()
+        dxf.set_manifest(tag, manifest)
+        with self.lock:
+            for result in results:
+                self.stats[result] += 1
+        print('{}:{} pushed: {} layers mounted, {} uploaded, {} already there'.format(
+            repo_full, tag, results.count('mounted'), results.count('uploaded'), results.count('existing')))
+        return 'sha256:' + hashlib.sha256(manifest.encode('utf-8')).hexdigest()
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.images = {}
+        self.layers = {}
+        self.users = {}
+        self.idle = OrderedDict()
+        self.idle_size = 0
+        if self.cache_path is None:
+            return
+        with self.lock:
+            save_json(self.cache_path, self.blobs)
+
+    def report(self):
+        print('Blob push engine: {} layers mounted, {} uploaded, {} already there'.format(
+            self.stats['mounted'], self.stats['uploaded'], self.stats['existing']))
@@ -2,27 +2,40 @@
 
 import argparse
 
-import json
-
 import docker
 import git
 import traceback
+import signal
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from os import listdir, environ
-from os.path import isfile, join, isdir
+from os.path import isfile, join, basename
 from dockerhub import Dockerhub
 from harbor import Harbor
+from registry import BASE_IMAGES
+from scheduler import Scheduler
+from changes import ChangeIndex
+from basecache import BaseImageCache, requirements_hash
+from baseimages import BaseImages
+from buildcontext import BuildContext
+from sharedlayers import SharedLayers
+from wheelhouse import Wheelhouse, WHEELHOUSE_SIZE
+from blobpush import BlobPusher
+from report import RunReport
+from flavors import FlavorIndex
+from plan import BuildPlan
+from watch import CommitWatcher, REFRESH_INTERVAL, WATCH_INTERVAL
+from shards import parse_shard, measure, DurationHistory, ShardError, shard_workers, write_summary, merge_summaries
 
 
-def list_flavor(path):
-    if isdir(path):
-        for flavor_filename in listdir(path):
-            if isfile(join(path, flavor_filename)) and flavor_filename.endswith('.json'):
-                with open(join(path, flavor_filename)) as flavor_file:
-                    flavor = json.load(flavor_file)
-                    yield flavor
-    else:
-        return []
+def list_workers(args):
+    """
+    Paths of the workers to build: the --worker ones, else every entry of
+    the workers directory.
+    """
+    workers = args.worker_names if args.worker_names is not None else listdir(args.worker_path)
+    return sorted(join(args.worker_path, w) for w in workers)
 
 
 def git_commit_sha(base_path):
@@ -32,92 +45,450 @@ def git_commit_sha(base_path):
 def worker_is_updated(args, registry, flavor, worker_path, list_summary):
     tag = flavor['version'] if args.stable else 'devel'
     try:
-        last_commit = registry.last_build_commit(args.namespace, flavor['name'].lower(), tag)
+        with args.report.timed(flavor['name'], 'remote_lookup', registry.name()):
+            last_hash = registry.build_content_hash(args.namespace, flavor['name'].lower(), tag)
+        if last_hash is not None and flavor.get('content_hash') is not None:
+            if last_hash == flavor['content_hash']:
+                print('Previous Docker image of worker {} has been built from the same content, no change detected ({})'
+                      .format(flavor['name'].lower(), registry.name()))
+                list_summary[0].append('{} ({})'.format(flavor['name'], registry.name()))
+                args.report.update(flavor['name'], registry.name(), decision='built from the same content')
+                return False
+            print('Previous Docker image of worker {} has been built from another content, rebuild it ({})'
+                  .format(flavor['name'].lower(), registry.name()))
+            args.report.update(flavor['name'], registry.name(), decision='built from another content')
+            return True
+        with args.report.timed(flavor['name'], 'remote_lookup', registry.name()):
+            last_commit = registry.build_commit(args.namespace, flavor['name'].lower(), tag)
         if last_commit is None:
             print('No previous Docker image found for worker {}, build it ({})'
                   .format(flavor['name'].lower(), registry.name()))
+            args.report.update(flavor['name'], registry.name(), decision='no previous image')
             return True
     except Exception as e:
         print(f"Error retrieving last build commit for {flavor['name'].lower()}: {e} -- Still proceeding to update")
+        args.report.update(flavor['name'], registry.name(), decision='remote lookup failed: {}'.format(e))
         return True
     try:
-        repo = git.Repo(args.base_path)
-        head = repo.head.commit
-        for change in head.diff(other=last_commit):
-            if change.a_path.startswith(worker_path) or \
-                    change.b_path.startswith(worker_path):
-                print(
-                    'Previous Docker image of worker {} has been built from commit {}, changed detected, '
-                    'rebuild it ({})'
-                    .format(flavor['name'].lower(), last_commit, registry.name()))
-                return True
+        with args.report.timed(flavor['name'], 'change_detection'):
+            changed = args.change_index.is_changed(last_commit, worker_path)
+        if changed:
+            print(
+                'Previous Docker image of worker {} has been built from commit {}, changed detected, '
+                'rebuild it ({})'
+                .format(flavor['name'].lower(), last_commit, registry.name()))
+            args.report.update(flavor['name'], registry.name(), decision='changed since {}'.format(last_commit))
+            return True
         print('Previous Docker image of worker {} has been built from commit {}, no change detected ({})'
               .format(flavor['name'].lower(), last_commit, registry.name()))
         list_summary[0].append('{} ({})'.format(flavor['name'], registry.name()))
+        args.report.update(flavor['name'], registry.name(), decision='unchanged since {}'.format(last_commit))
         return False
     except Exception as e:
         print("Worker update check failed: {}".format(e))
+        args.report.update(flavor['name'], registry.name(), decision='change detection failed: {}'.format(e))
         return True
 
 
+def push_flavor(args, registry, flavor, list_summary):
+    try:
+        tag = flavor['version'] if args.stable else 'devel'
+        stats = {}
+        with args.report.timed(flavor['name'], 'push', registry.name()):
+            digest = registry.push(args.namespace, flavor['repo'], tag, stats=stats)
+        # the published labels have changed: looked up again by the next run of --watch
+        registry.image_labels.pop((args.namespace, flavor['repo'], tag), None)
+        args.report.update(flavor['name'], registry.name(), digest=digest)
+        if stats:
+            # layers sent, bytes and throughput of the push stream
+            args.report.update(flavor['name'], registry.name(), push_stream=stats)
+        if '.' in tag:
+            major = tag.split('.', 1)[0]
+            with args.report.timed(flavor['name'], 'tag', registry.name()):
+                try:
+                    # The major version tag points to the manifest just pushed
+                    registry.retag_image(args.namespace, flavor['repo'], digest or tag, major)
+                    print('Tag {}/{}:{} created on {}'.format(args.namespace, flavor['repo'], major, registry.name()))
+                except Exception as e:
+                    print('Registry-side tagging of {}/{}:{} failed ({}), push it'
+                          .format(args.namespace, flavor['repo'], major, e))
+                    registry.push(args.namespace, flavor['repo'], major)
+        with args.report.timed(flavor['name'], 'verification', registry.name()):
+            verified = registry.correctly_pushed(args.namespace, flavor['repo'], tag, digest)
+        args.report.update(flavor['name'], registry.name(), verified=verified)
+        if not verified:
+            # raise Exception(
+            #     "Neurons {}/{}:{} is not correctly pushed on {}"
+            #     .format(args.namespace, flavor['repo'], tag, registry.name()))
+            print(f"WARN: Neurons {args.namespace}/{flavor['repo']}:{tag} on {registry.name()} does not match the pushed digest {digest}: the tag may have been pushed again since.")
+        list_summary[1].append('{} ({})'.format(flavor['name'], registry.name()))
+        args.report.update(flavor['name'], registry.name(), status='pushed')
+    except Exception as e:
+        print("push workers failed: {}".format(e))
+        traceback.print_exc()
+        args.report.update(flavor['name'], registry.name(), status='failed', error=str(e))
+        list_summary[2].append('{} ({}) -> {}'
+                               .format(flavor['name'], registry.name(), e))
+    finally:
+        if args.blob_pusher is not None:
+            # the exported image is dropped after its last push
+            args.blob_pusher.done('{}/{}'.format(args.namespace, flavor['repo']))
+
+
+def flavor_content_hash(args, worker_path, flavor):
+    if not args.registry:
+        return None
+    try:
+        with args.report.timed(flavor['name'], 'change_detection'):
+            tree_id = args.change_index.tree_id(worker_path)
+            worker_dir = join(args.base_path, worker_path)
+            context_files = None
+            if args.minimal_context and not isfile(join(worker_dir, 'Dockerfile')):
+                context_files = BuildContext(args.base_path, worker_path, flavor).files
+            dependency_set = None
+            if args.shared_layers is not None:
+                dependency_set = args.shared_layers.dependency_set(worker_dir)
+            return args.registry[0].content_hash(tree_id, args.base_path, worker_path, flavor,
+                                                 args.use_wheelhouse, args.optimize_images,
+                                                 context_files, dependency_set)
+    except Exception as e:
+        print("Content hash of worker {} failed: {}".format(flavor['name'], e))
+        return None
+
+
+def flavor_registries(args, worker_path, flavor, list_summary):
+    """
+    Registries the flavor has to be pushed to, the reason of each decision
+    being recorded in the report.
+    """
+    flavor['content_hash'] = flavor_content_hash(args, worker_path, flavor)
+    if args.force:
+        for registry in args.registry:
+            args.report.update(flavor['name'], registry.name(), decision='forced')
+        return list(args.registry)
+    # The "needs build" decision is merged across registries: the image is
+    # built once and pushed to every registry that needs it.
+    return [registry
+            for registry in args.registry
+            if worker_is_updated(args, registry, flavor, worker_path, list_summary)]
+
+
+def build_flavor(args, scheduler, worker_path, flavor, git_commit, list_summary, registries=None):
+    args.report.update(flavor['name'], worker=basename(worker_path), version=flavor['version'])
+    if registries is None:
+        registries = flavor_registries(args, worker_path, flavor, list_summary)
+    if not registries:
+        args.report.update(flavor['name'], status='skipped')
+        return
+
+    try:
+        flavor['repo'] = flavor['name'].lower()
+        print('Worker {} has been updated'.format(flavor['name']))
+        registries[0].build_docker(args.namespace, args.base_path, worker_path, flavor, git_commit,
+                                   flavor['content_hash'], args.base_cache, args.base_images,
+                                   args.shared_layers, args.wheelhouse, args.report,
+                                   minimal_context=args.minimal_context, optimized=args.optimize_images,
+                                   measure_startup=args.measure_startup or args.optimize_images)
+        args.report.update(flavor['name'], status='built')
+    except Exception as e:
+        print("build workers failed: {}".format(e))
+        traceback.print_exc()
+        args.report.update(flavor['name'], status='failed', error=str(e))
+        for registry in registries:
+            list_summary[2].append('{} ({}) -> {}'
+                                   .format(flavor['name'], registry.name(), e))
+        return
+
+    # One push task per registry, so that a push never waits on another registry
+    if args.blob_pusher is not None:
+        args.blob_pusher.expect('{}/{}'.format(args.namespace, flavor['repo']), len(registries))
+    for registry in registries:
+        scheduler.submit_push(flavor['name'], push_flavor, args, registry, flavor, list_summary)
+
+
+def build_planned_worker(args, scheduler, worker_path, git_commit, list_summary):
+    for flavor, push, skip in args.plan.flavors_of(worker_path):
+        with scheduler.capture(flavor['name']):
+            for registry in args.registry:
+                if registry.name() in skip:
+                    print('Worker {} skipped on {} by the plan: {}'
+                          .format(flavor['name'], registry.name(), skip[registry.name()]))
+                    list_summary[0].append('{} ({})'.format(flavor['name'], registry.name()))
+                    args.report.update(flavor['name'], registry.name(), decision=skip[registry.name()])
+            build_flavor(args, scheduler, worker_path, flavor, git_commit, list_summary,
+                         [registry for registry in args.registry if registry.name() in push])
+
+
+def build_worker(args, scheduler, worker_path, git_commit, list_summary):
+    if args.plan is not None:
+        build_planned_worker(args, scheduler, worker_path, git_commit, list_summary)
+        return
+    for flavor in args.flavor_index.flavors(worker_path):
+        # Output of each flavor goes to its own log file
+        with scheduler.capture(flavor['name']):
+            build_flavor(args, scheduler, worker_path, flavor, git_commit, list_summary)
+
+
+def prefetch_remote_state(args):
+    repo_tags = sorted({(flavor['name'].lower(), flavor['version'] if args.stable else 'devel')
+                        for worker_path in args.workers
+                        for flavor in args.flavor_index.flavors(worker_path)})
+
+    def prefetch(registry):
+        # with --watch, the labels of the images not pushed since the last run are known
+        missing = [repo_tag for repo_tag in repo_tags if (args.namespace,) + repo_tag not in registry.image_labels]
+        try:
+            if missing:
+                registry.prefetch_labels(args.namespace, missing)
+        except Exception as e:
+            print("Remote state prefetch failed ({}): {}".format(registry.name(), e))
+
+    start = time.monotonic()
+    with args.report.timed(None, 'remote_lookup'):
+        with ThreadPoolExecutor(max_workers=max(1, len(args.registry))) as pool:
+            list(pool.map(prefetch, args.registry))
+    print('Remote state prefetch: {} images on {} registries, {:.2f}s'
+          .format(len(repo_tags), len(args.registry), time.monotonic() - start))
+
+
+def planned_base(args, worker_path):
+    """
+    Base image the worker is expected to build on: the first one tried.
+    """
+    worker_dir = join(args.base_path, worker_path)
+    if isfile(join(worker_dir, 'Dockerfile')):
+        return 'Dockerfile'
+    return args.base_cache.order(basename(worker_path), requirements_hash(worker_dir), BASE_IMAGES)[0]
+
+
+def plan_workers(args, git_commit, durations):
+    """
+    Flavor discovery, change detection and remote lookups of a run, without
+    building nor pushing anything: the resulting plan is written to
+    --plan and displayed.
+    """
+    plan = BuildPlan(git_commit, args.namespace, args.stable, [registry.name() for registry in args.registry],
+                     bool(args.force), args.shard)
+    plan.partition = args.partition
+    args.shared_layers = None
+    if args.shared_layers_min > 0:
+        args.shared_layers = SharedLayers.plan(None, args.namespace, args.base_path, args.workers,
+                                               args.shared_layers_min, args.registry)
+        plan.shared_layers = [sorted(dependency_set) for dependency_set in args.shared_layers.dependency_sets]
+    if not args.force:
+        prefetch_remote_state(args)
+    for worker_path in args.workers:
+        for flavor in args.flavor_index.flavors(worker_path):
+            registries = flavor_registries(args, worker_path, flavor, [[], [], []])
+            decisions = args.report.flavor(flavor['name'])['registries']
+            shared = None
+            if args.shared_layers is not None:
+                dependency_set = args.shared_layers.dependency_set(join(args.base_path, worker_path))
+                shared = sorted(dependency_set) if dependency_set is not None else None
+            plan.add(worker_path, flavor, planned_base(args, worker_path), [r.name() for r in registries],
+                     {registry.name(): decisions[registry.name()]['decision']
+                      for registry in args.registry if registry not in registries}, shared)
+    plan.build_nodes(args.report.previous, durations, args.jobs, args.push_jobs,
+                     args.report.previous_run.get('phases', {}).get('shared_layers'))
+    plan.save(args.plan_path)
+    plan.display()
+
+
+def open_caches(args):
+    """
+    Caches used by the runs: opened for each run, or once for all the runs
+    of --watch, which keeps them in memory.
+    """
+    args.flavor_index = FlavorIndex(join(args.cache_dir, 'flavors.json'))
+    args.base_cache = BaseImageCache(join(args.cache_dir, 'base-images.json'))
+    args.base_images = BaseImages(args.docker_client)
+    args.wheelhouse = None
+    if args.use_wheelhouse:
+        args.wheelhouse = Wheelhouse(join(args.cache_dir, 'wheelhouse'), args.wheelhouse_size)
+
+
 def build_workers(args, list_summary):
+    if not args.watch:
+        open_caches(args)
     git_commit = git_commit_sha(args.base_path)
-    for worker_path in args.workers:
-        list_builds = []
-        for registry in args.registry:
-            updated_flavors = [flavor
-                               for flavor in list_flavor(join(args.base_path, worker_path))
-                               if args.force or worker_is_updated(args, registry, flavor, worker_path, list_summary)]
+    args.report = RunReport(args.report_path)
+    args.report.run.update(commit=git_commit, jobs=args.jobs, force=bool(args.force),
+                           registries=[registry.name() for registry in args.registry])
+    durations = DurationHistory(args.durations_path)
+    args.measured_durations = None
+    args.plan = None
+    args.partition = None
+    if args.execute_plan_path is not None:
+        # Flavors, change detection and remote lookups come from the plan
+        args.plan = BuildPlan.load(args.execute_plan_path)
+        args.plan.check(git_commit, args.namespace, args.stable, [registry.name() for registry in args.registry])
+        args.workers = args.plan.workers
+        args.report.run.update(plan=args.execute_plan_path, force=args.plan.force)
+        if args.plan.shard is not None:
+            args.shard = args.plan.shard
+            args.partition = args.plan.partition
+            args.report.run.update(shard='{}/{}'.format(*args.plan.shard))
+    else:
+        # Invalid manifests stop the run here, before anything is built or pushed
+        try:
+            args.flavor_index.scan(args.base_path, args.workers)
+        finally:
+            args.flavor_index.save()
+        if args.shard is not None:
+            args.workers, args.partition = shard_workers(args.workers, durations, *args.shard)
+            args.report.run.update(shard='{}/{}'.format(*args.shard))
+    args.change_index = ChangeIndex(args.base_path)
+    if args.plan_path is not None:
+        plan_workers(args, git_commit, durations)
+        return
+    args.blob_pusher = None
+    if args.push_engine == 'blob':
+        args.blob_pusher = BlobPusher(args.docker_client, join(args.cache_dir, 'blobs.json'))
+    for registry in args.registry:
+        registry.push_engine = args.blob_pusher
+    args.shared_layers = None
+    if args.shared_layers_min > 0:
+        with args.report.timed(None, 'shared_layers'):
+            # with --watch, the dependency sets of every worker, not only of the changed ones
+            args.shared_layers = SharedLayers.plan(args.docker_client, args.namespace, args.base_path,
+                                                   list_workers(args) if args.watch else args.workers,
+                                                   args.shared_layers_min, args.registry)
+    if not args.force and args.plan is None:
+        prefetch_remote_state(args)
+    scheduler = Scheduler(args.jobs, args.push_jobs, args.log_dir)
+    with args.report.timed(None, 'workers'):
+        with scheduler.running():
+            for worker_path in args.workers:
+                scheduler.submit_build(basename(worker_path), build_worker,
+                                       args, scheduler, worker_path, git_commit, list_summary)
+    # unexpected errors of the tasks (not a failed build or push): the run fails
+    for name, error in scheduler.errors:
+        list_summary[2].append('{} -> {}: {}'.format(name, type(error).__name__, error))
+    args.change_index.report()
+    args.base_cache.save()
+    args.base_cache.report()
+    args.base_images.report()
+    if args.shared_layers is not None:
+        args.shared_layers.push()
+        args.shared_layers.report()
+    if args.wheelhouse is not None:
+        args.wheelhouse.report()
+    if args.blob_pusher is not None:
+        args.blob_pusher.close()
+        args.blob_pusher.report()
+    args.report.run.update(base_cache={'hits': args.base_cache.hits, 'misses': args.base_cache.misses})
+    args.report.write()
+    args.measured_durations = measure(args.report.records())
+    # the shards share the history: it is only updated when their summaries are merged
+    if args.shard is None:
+        durations.update(args.measured_durations)
+        durations.save()
+
 
-            for flavor in updated_flavors:
+def failed_workers(records):
+    """
+    Workers with a flavor whose build or one of its pushes failed.
+    """
+    return {record['worker'] for record in records
+            if record.get('type') == 'flavor' and 'worker' in record and
+            (record.get('status') == 'failed' or
+             any(registry.get('status') == 'failed' for registry in record['registries'].values()))}
+
+
+def watch(args):
+    """
+    Build HEAD, then every new commit: only the workers changed since the
+    last commit built, and the ones that failed, are rebuilt. The registry
+    sessions, the remote state, the flavor index, the base image pins and
+    the layer cache of the daemon are kept warm between builds.
+    """
+    watcher = CommitWatcher(args.base_path, args.watch_interval, args.watch_socket)
+    open_caches(args)
+    refreshed = time.monotonic()
+    seen_commit = built_commit = None
+    retry = set()
+    try:
+        while True:
+            commit = watcher.wait(seen_commit)
+            seen_commit = commit
+            if time.monotonic() - refreshed > REFRESH_INTERVAL:
+                args.base_images = BaseImages(args.docker_client)
+                for registry in args.registry:
+                    registry.image_labels = {}
+                refreshed = time.monotonic()
+            workers = list_workers(args)
+            if built_commit is not None:
                 try:
-                    flavor['repo'] = flavor['name'].lower()
-                    print('Worker {} has been updated'.format(flavor['name']))
-
-                    if flavor['name'] not in list_builds:
-                        registry.build_docker(args.namespace, args.base_path, worker_path, flavor, git_commit)
-                        list_builds.append(flavor['name'])
-
-                    tag = flavor['version'] if args.stable else 'devel'
-                    registry.push_image(args.namespace, flavor['repo'], tag)
-                    if '.' in tag:
-                        registry.push_image(args.namespace, flavor['repo'], tag.split('.', 1)[0])
-                    if not registry.correctly_pushed(args.namespace, flavor['repo'], tag):
-                        # raise Exception(
-                        #     "Neurons {}/{}:{} is not correctly pushed on {}"
-                        #     .format(args.namespace, flavor['repo'], tag, registry.name()))
-                        print(f"WARN: Neurons {args.namespace}/{flavor['repo']}:{tag} digest check failed on {registry.name()}. This however, does not mean a push failed. Data returned by this function or call may not be up-to-date in some instances.")
-                    list_summary[1].append('{} ({})'.format(flavor['name'], registry.name()))
+                    changes = ChangeIndex(args.base_path)
+                    workers = [worker_path for worker_path in workers
+                               if basename(worker_path) in retry or changes.is_changed(built_commit, worker_path)]
                 except Exception as e:
-                    print("build workers failed: {}".format(e))
-                    traceback.print_exc()
-                    list_summary[2].append('{} ({}) -> {}'
-                                           .format(flavor['name'], registry.name(), e))
+                    print('Changes since {} unknown, every worker is checked: {}'.format(built_commit, e))
+            print('Commit {}: {} workers to build'.format(commit, len(workers)))
+            if not workers:
+                built_commit = commit
+                continue
+            args.workers = workers
+            args.base_cache.hits = args.base_cache.misses = 0
+            start = time.monotonic()
+            list_summary = [[], [], []]
+            try:
+                build_workers(args, list_summary)
+            except Exception as e:
+                # e.g. invalid flavor manifests: the next commit is compared to the last one built
+                print('Build of commit {} failed: {}'.format(commit, e))
+                traceback.print_exc()
+                continue
+            built_commit = commit
+            retry = failed_workers(args.report.records())
+            display_list_summary(list_summary, exit_on_failure=False)
+            print('Commit {} done in {:.1f}s'.format(commit, time.monotonic() - start))
+    finally:
+        watcher.close()
 
 
-def display_list_summary(list_summary):
+def display_list_summary(list_summary, exit_on_failure=True):
     sys.stderr.flush()
     sys.stdout.flush()
 
     if len(list_summary[0]) != 0:
-        for update in list_summary[0]:
+        for update in sorted(list_summary[0]):
             print('[SKIPPED] {}'.format(update))
 
     if len(list_summary[1]) != 0:
-        for update in list_summary[1]:
+        for update in sorted(list_summary[1]):
             print('[SUCCEED] {}'.format(update))
 
     if len(list_summary[2]) != 0:
-        for update in list_summary[2]:
+        for update in sorted(list_summary[2]):
             print('[FAILED]  {}'.format(update))
-        exit(1)
+        if exit_on_failure:
+            exit(1)
 
 
-def main():
+def parse_args(argv=None):
     namespace = environ.get('PLUGIN_NAMESPACE')
     stable = environ.get('PLUGIN_STABLE') is not None
     worker_path = environ.get('PLUGIN_WORKER_PATH', 'analyzers')
     force = environ.get('PLUGIN_FORCE', False)
+    jobs = int(environ.get('PLUGIN_JOBS', 1))
+    push_jobs = environ.get('PLUGIN_PUSH_JOBS')
+    log_dir = environ.get('PLUGIN_LOG_DIR')
+    cache_dir = environ.get('PLUGIN_CACHE_DIR', '.neurons-builder')
+    shared_layers_min = int(environ.get('PLUGIN_SHARED_LAYERS', 0))
+    use_wheelhouse = environ.get('PLUGIN_WHEELHOUSE') is not None
+    wheelhouse_size = int(environ.get('PLUGIN_WHEELHOUSE_SIZE', WHEELHOUSE_SIZE))
+    push_engine = environ.get('PLUGIN_PUSH_ENGINE', 'daemon')
+    report_path = environ.get('PLUGIN_REPORT')
+    shard = environ.get('PLUGIN_SHARD')
+    summary_path = environ.get('PLUGIN_SUMMARY')
+    durations_path = environ.get('PLUGIN_DURATIONS')
+    minimal_context = environ.get('PLUGIN_MINIMAL_CONTEXT') is not None
+    optimize_images = environ.get('PLUGIN_OPTIMIZE_IMAGES') is not None
+    measure_startup = environ.get('PLUGIN_MEASURE_STARTUP') is not None
+    watch_mode = environ.get('PLUGIN_WATCH') is not None
+    watch_interval = float(environ.get('PLUGIN_WATCH_INTERVAL', WATCH_INTERVAL))
+    watch_socket = environ.get('PLUGIN_WATCH_SOCKET')
 
     registry_dockerhub = (environ.get('PLUGIN_REGISTRY_DOCKERHUB') or "").split(",")
     if registry_dockerhub[0] == "":
@@ -129,7 +500,6 @@ def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-n', '--namespace',
-                        required=namespace is None,
                         default=namespace,
                         help='Namespace of docker images')
     parser.add_argument('-rd', '--registry_dockerhub',
@@ -146,7 +516,7 @@ def main():
                         help='Add release tags')
     parser.add_argument('-w', '--worker',
                         action='append',
-                        dest='workers',
+                        dest='worker_names',
                         help='Path of the worker (relative to base path) to build')
     parser.add_argument('--path',
                         default=worker_path,
@@ -159,26 +529,166 @@ def main():
                         default=force,
                         action='store_true',
                         help='Force build Docker image even without any change')
-    args = parser.parse_args()
-    args.docker_client = docker.from_env()
+    parser.add_argument('-j', '--jobs',
+                        type=int,
+                        default=jobs,
+                        help='Number of workers built in parallel')
+    parser.add_argument('--push-jobs',
+                        type=int,
+                        default=push_jobs,
+                        help='Number of images pushed in parallel (default: --jobs times the number of registries)')
+    parser.add_argument('--log-dir',
+                        default=log_dir,
+                        help='Directory where the output of each flavor is written (<flavor>.log, replaced at '
+                             'each run, default: logs in the cache directory)')
+    parser.add_argument('--cache-dir',
+                        default=cache_dir,
+                        help='Directory of the caches kept between runs')
+    parser.add_argument('--shared-layers',
+                        type=int,
+                        default=shared_layers_min,
+                        dest='shared_layers_min',
+                        help='Install the dependencies common to at least N workers in shared base images '
+                             '(default: 0, disabled)')
+    parser.add_argument('--wheelhouse',
+                        action='store_true',
+                        default=use_wheelhouse,
+                        dest='use_wheelhouse',
+                        help='Reuse the wheels compiled by previous builds (kept in the cache directory)')
+    parser.add_argument('--wheelhouse-size',
+                        type=int,
+                        default=wheelhouse_size,
+                        help='Size of the wheelhouse of each base image in MB, the least recently used wheels '
+                             'being removed above it (default: {})'.format(WHEELHOUSE_SIZE))
+    parser.add_argument('--push-engine',
+                        choices=['daemon', 'blob'],
+                        default=push_engine,
+                        help='Push with the Docker daemon, or through the registry API with cross-repository '
+                             'blob mounts (default: daemon)')
+    parser.add_argument('--minimal-context',
+                        action='store_true',
+                        default=minimal_context,
+                        help='Send only the files each flavor needs (entrypoint, local imports, requirements, '
+                             'data files and the .neurons-assets patterns) as build context')
+    parser.add_argument('--optimize-images',
+                        action='store_true',
+                        default=optimize_images,
+                        help='Generate multi-stage Dockerfiles installing the dependencies and compiling all python '
+                             'files to bytecode in a builder stage (implies --measure-startup)')
+    parser.add_argument('--measure-startup',
+                        action='store_true',
+                        default=measure_startup,
+                        help='Measure the time from container start to the first import of each flavor')
+    parser.add_argument('--report',
+                        default=report_path,
+                        dest='report_path',
+                        help='JSON lines run report, with the timings of each flavor '
+                             '(default: report.jsonl in the cache directory)')
+    parser.add_argument('--shard',
+                        type=parse_shard,
+                        default=shard,
+                        help='Build the i-th of N shards of the workers (i/N), balanced on the build durations '
+                             'of previous runs; all shards must read the same --durations file')
+    parser.add_argument('--summary',
+                        default=summary_path,
+                        dest='summary_path',
+                        help='Write the SKIPPED/SUCCEED/FAILED lists to this JSON file '
+                             '(default with --shard: summary-<i>-of-<N>.json in the cache directory)')
+    parser.add_argument('--durations',
+                        default=durations_path,
+                        dest='durations_path',
+                        help='JSON file of the build duration of each worker, read to balance the shards and '
+                             'updated by the runs without --shard and by --merge-summary '
+                             '(default: durations.json in the cache directory)')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        default=watch_mode,
+                        help='Keep running: build HEAD, then each new commit of the repository (or sent to '
+                             '--watch-socket), rebuilding only the changed workers with warm caches')
+    parser.add_argument('--watch-interval',
+                        type=float,
+                        default=watch_interval,
+                        help='Seconds between two checks of HEAD with --watch (default: {})'.format(WATCH_INTERVAL))
+    parser.add_argument('--watch-socket',
+                        default=watch_socket,
+                        help='Unix socket receiving the commits to build with --watch, one sha or ref per '
+                             'connection, fetched and checked out before the build')
+    parser.add_argument('--plan',
+                        dest='plan_path',
+                        help='Do not build nor push: write the plan of the run (flavors to build with their base '
+                             'image, registries and tags to push, skipped flavors and why, estimated durations) '
+                             'to this JSON file and display it')
+    parser.add_argument('--execute-plan',
+                        dest='execute_plan_path',
+                        help='Run the plan written by --plan, on the same commit, without the change detection '
+                             'and remote lookups')
+    parser.add_argument('--merge-summary',
+                        action='append',
+                        dest='merge_summaries',
+                        help='Do not build: merge the summary files written by the shards of a run, record '
+                             'their build durations in --durations and display the result')
+    args = parser.parse_args(argv)
+    if args.namespace is None and args.merge_summaries is None:
+        parser.error('the following arguments are required: -n/--namespace')
+    if args.log_dir is None:
+        args.log_dir = join(args.cache_dir, 'logs')
+    if args.report_path is None:
+        args.report_path = join(args.cache_dir, 'report.jsonl')
+    if args.durations_path is None:
+        args.durations_path = join(args.cache_dir, 'durations.json')
+    if args.plan_path is not None and args.execute_plan_path is not None:
+        parser.error('--plan and --execute-plan are exclusive')
+    if args.watch and (args.shard is not None or args.plan_path is not None or args.execute_plan_path is not None):
+        parser.error('--watch can\'t be used with --shard, --plan or --execute-plan')
+    if args.summary_path is None and args.shard is not None:
+        args.summary_path = join(args.cache_dir, 'summary-{}-of-{}.json'.format(*args.shard))
+    return args
+
+
+def main():
+    args = parse_args()
+    if args.merge_summaries is not None:
+        durations = DurationHistory(args.durations_path)
+        try:
+            list_summary = merge_summaries(args.merge_summaries, durations)
+        except ShardError as e:
+            print('Summaries not merged: {}'.format(e))
+            exit(1)
+        durations.save()
+        display_list_summary(list_summary)
+        return
+    # A plan only queries the registry APIs: no Docker daemon needed
+    args.docker_client = docker.from_env() if args.plan_path is None else None
     args.registry = []
 
     for registry_string in args.registry_dockerhub:
         registry = Dockerhub(args.docker_client, registry_string)
-        registry.login()
+        if args.plan_path is None:
+            registry.login()
         args.registry.append(registry)
 
     for registry_string in args.registry_harbor:
         registry = Harbor(args.docker_client, registry_string)
-        registry.login()
+        if args.plan_path is None:
+            registry.login()
         args.registry.append(registry)
 
-    if args.workers is None:
-        args.workers = listdir(args.worker_path)
-    args.workers = [join(args.worker_path, w) for w in args.workers]
+    if args.push_jobs is None:
+        args.push_jobs = args.jobs * max(1, len(args.registry))
+
+    if args.watch:
+        # docker stop: leave the watch loop (and close its socket) cleanly
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        watch(args)
+        return
+    args.workers = list_workers(args)
 
     list_summary = [[], [], []]
     build_workers(args, list_summary)
+    if args.plan_path is not None:
+        return
+    if args.summary_path is not None:
+        write_summary(args.summary_path, args.shard, list_summary, args.partition, args.measured_durations)
     display_list_summary(list_summary)
 
 
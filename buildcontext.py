@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import ast
+import fnmatch
+import io
+import json
+import tarfile
+import tempfile
+from os import walk
+from os.path import basename, dirname, getsize, isdir, isfile, join, normpath, relpath
+
+# Patterns of files and directories never sent to the daemon
+EXCLUDED = ["__pycache__", "*.pyc", "*.pyo", ".git*", ".DS_Store", ".venv", "venv", "node_modules",
+            "test", "tests", "sample", "samples", "fixtures", "examples", "docs", "*.md", "*.rst", "*.log",
+            "Dockerfile", ".dockerignore"]
+# Optional file of a worker with the patterns of files it needs at run time
+# that are not found from its entrypoint (data files, dynamically loaded modules)
+ASSETS_FILE = ".neurons-assets"
+# Context files kept in memory up to this size, then on disk
+SPOOL_SIZE = 32 * 1024 * 1024
+
+
+def excluded(path):
+    return any(fnmatch.fnmatch(part, pattern) for part in path.split('/') for pattern in EXCLUDED)
+
+
+def context_size(directory):
+    """
+    Size of the files of a directory, i.e. of the full build context.
+    """
+    return sum(getsize(join(root, name)) for root, dirs, files in walk(directory) for name in files)
+
+
+def is_flavor(path):
+    try:
+        with open(path) as flavor_file:
+            flavor = json.load(flavor_file)
+        return isinstance(flavor, dict) and 'name' in flavor and 'command' in flavor
+    except Exception:
+        return False
+
+
+class BuildContext:
+    """
+    Minimal build context of a flavor: its entrypoint, the local modules it
+    imports (transitively), requirements.txt, the files declared in the
+    .neurons-assets file of the worker and its other data files. Other python
+    files, flavor definitions, tests, samples, caches and documentation are
+    left out.
+    """
+
+    def __init__(self, base_path, worker_path, flavor):
+        self.worker_dir = normpath(join(base_path, worker_path))
+        entrypoint = join(base_path, dirname(worker_path), flavor['command'])
+        if not isfile(entrypoint):
+            entrypoint = join(self.worker_dir, basename(flavor['command']))
+        # nothing known about the imports without entrypoint: keep every python file
+        modules = self.local_modules(entrypoint) if isfile(entrypoint) else None
+        assets = self.assets()
+
+        self.files = []
+        for root, dirs, files in walk(self.worker_dir):
+            dirs.sort()
+            for name in sorted(files):
+                path = relpath(join(root, name), self.worker_dir)
+                if any(fnmatch.fnmatch(path, pattern) for pattern in assets):
+                    self.files.append(path)
+                elif excluded(path) or path == ASSETS_FILE:
+                    continue
+                elif path.endswith('.py'):
+                    if modules is None or path in modules:
+                        self.files.append(path)
+                elif not (dirname(path) == '' and path.endswith('.json') and is_flavor(join(root, name))):
+                    self.files.append(path)
+        self.size = sum(getsize(join(self.worker_dir, path)) for path in self.files)
+
+    def assets(self):
+        path = join(self.worker_dir, ASSETS_FILE)
+        if not isfile(path):
+            return []
+        with open(path) as assets_file:
+            return [line.strip() for line in assets_file if line.strip() and not line.startswith('#')]
+
+    def module_files(self, directory, module):
+        """
+        Files of the worker defining module, relative to directory: the
+        module file and the __init__.py of its packages.
+        """
+        files = []
+        path = directory
+        for part in module.split('.'):
+            path = join(path, part)
+            if isfile(path + '.py'):
+                files.append(path + '.py')
+                break
+            if isfile(join(path, '__init__.py')):
+                files.append(join(path, '__init__.py'))
+            elif not isdir(path):
+                break
+        return files
+
+    def local_modules(self, entrypoint):
+        """
+        Python files of the worker reached from the entrypoint through its
+        imports, at any level (imports in functions or try blocks included).
+        """
+        found = {normpath(entrypoint)}
+        pending = [normpath(entrypoint)]
+        roots = {dirname(normpath(entrypoint)), self.worker_dir}
+        while pending:
+            path = pending.pop()
+            try:
+                with open(path, encoding='utf-8') as source:
+                    tree = ast.parse(source.read(), path)
+            except (SyntaxError, ValueError, UnicodeDecodeError):
+                continue
+            for node in ast.walk(tree):
+                modules = []
+                if isinstance(node, ast.Import):
+                    modules = [(root, alias.name) for root in roots for alias in node.names]
+                elif isinstance(node, ast.ImportFrom):
+                    if node.level:
+                        directory = dirname(path)
+                        for _ in range(node.level - 1):
+                            directory = dirname(directory)
+                        directories = [directory]
+                    else:
+                        directories = roots
+                    for directory in directories:
+                        prefix = '{}.'.format(node.module) if node.module else ''
+                        if node.module:
+                            modules.append((directory, node.module))
+                        # from package import submodule
+                        modules += [(directory, prefix + alias.name) for alias in node.names]
+                for directory, module in modules:
+                    for module_file in self.module_files(directory, module):
+                        module_file = normpath(module_file)
+                        if module_file not in found and module_file.startswith(self.worker_dir + '/'):
+                            found.add(module_file)
+                            pending.append(module_file)
+        return {relpath(path, self.worker_dir) for path in found}
+
+    def add(self, tar, prefix=''):
+        for path in self.files:
+            tar.add(join(self.worker_dir, path), arcname=join(prefix, path), recursive=False)
+
+    def tar(self, dockerfile):
+        """
+        Build context with the files of the flavor at its root, the
+        generated Dockerfile and a .dockerignore keeping both out of the
+        image (COPY . ...), as a spooled file.
+        """
+        context = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            self.add(tar)
+            for name, data in (('Dockerfile', dockerfile), ('.dockerignore', 'Dockerfile\n.dockerignore\n')):
+                data = data.encode('utf-8')
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        context.seek(0)
+        return context
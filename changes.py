@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+from bisect import bisect_left
+from os.path import normpath
+
+import git
+
+
+class ChangeIndex:
+    """
+    Set of paths changed between HEAD and a previous build commit.
+
+    The diff is computed once per distinct base commit and memoized: most
+    flavors have been built from the same few commits. The changed paths are
+    kept sorted so that "did anything under this worker path change?" is a
+    binary search instead of a scan of the whole diff.
+    """
+
+    def __init__(self, base_path):
+        self.repo = git.Repo(base_path)
+        self.head = self.repo.head.commit.hexsha
+        self.lock = threading.Lock()
+        self.commit_locks = {}
+        self.index = {}
+        self.queries = 0
+        self.diffs = 0
+        self.elapsed = 0.0
+
+    def changed_paths(self, base_commit):
+        with self.lock:
+            commit_lock = self.commit_locks.setdefault(base_commit, threading.Lock())
+        with commit_lock:
+            if base_commit not in self.index:
+                try:
+                    output = self.repo.git.diff('--name-only', '--no-renames', '-z', base_commit, self.head)
+                    self.index[base_commit] = sorted(path for path in output.split('\0') if path)
+                except Exception as e:
+                    # Remember the failure (e.g. commit missing from a shallow
+                    # clone) instead of running git again for every flavor.
+                    self.index[base_commit] = e
+                with self.lock:
+                    self.diffs += 1
+            paths = self.index[base_commit]
+        if isinstance(paths, Exception):
+            raise paths
+        return paths
+
+    def tree_id(self, worker_path):
+        """
+        Git tree object id of the worker directory at HEAD: identical content
+        gives the same id, whatever the commit history.
+        """
+        with self.lock:
+            return (self.repo.commit(self.head).tree / normpath(worker_path)).hexsha
+
+    def is_changed(self, base_commit, worker_path):
+        start = time.monotonic()
+        try:
+            paths = self.changed_paths(base_commit)
+            prefix = normpath(worker_path)
+            if prefix == '.':
+                return len(paths) != 0
+            i = bisect_left(paths, prefix + '/')
+            if i < len(paths) and paths[i].startswith(prefix + '/'):
+                return True
+            i = bisect_left(paths, prefix)
+            return i < len(paths) and paths[i] == prefix
+        finally:
+            with self.lock:
+                self.queries += 1
+                self.elapsed += time.monotonic() - start
+
+    def report(self):
+        print('Change detection: {} lookups, {} git diffs, {:.2f}s'
+              .format(self.queries, self.diffs, self.elapsed))
@@ -1,128 +1,90 @@
 #!/usr/bin/env python3
 
 import json
-import requests
-from dxf import DXF
-from registry import Registry
+from registry import Registry, VCS_REF_LABEL
 import traceback
-from docker.errors import BuildError, APIError
-from dxf.exceptions import DXFUnauthorizedError
+from concurrent.futures import ThreadPoolExecutor
+
+# Number of repositories requested in the scope of a single bearer token
+TOKEN_SCOPE_BATCH = 50
+# Docker Hub API (tags metadata)
+HUB_API = "https://hub.docker.com"
 
 class Dockerhub(Registry):
     def __init__(self, client, registry):
         super().__init__(client, registry, True)
+        self.hub_api = HUB_API
 
     def name(self):
         return "dockerhub"
 
-    def last_build_commit(self, namespace, repo, tag):
+    def last_labels(self, namespace, repo, tag):
         """
-        Retrieve the commit hash (vcs-ref) from the image manifest.
+        Retrieve the labels (vcs-ref, content hash...) from the image config.
         
         :param namespace: The namespace of the repository.
         :param repo: The repository name.
         :param tag: The image tag.
-        :return: The commit hash if found, otherwise None.
+        :return: The labels if the image is found, otherwise None.
         """
-        def auth(_dxf, response):
-            #print("DEBUG: Authenticating using provided credentials...")
-            try:
-                _dxf.authenticate(
-                    username=self.username,
-                    password=self.password,
-                    response=response,
-                    actions="*",
-                )
-            #    print("DEBUG: Authentication successful.")
-            except Exception as auth_err:
-                print(f"ERROR: Authentication failed: {auth_err}")
-                raise  # Propagate the error to be handled by the try/except
-    
         try:
             repo_full = f"{namespace}/{repo}"
             print(f"DEBUG: Fetching manifest for repository '{repo_full}' with tag '{tag}' from registry '{self.registry}'")
-            
-            # init
-            dxf = DXF(host=self.registry, repo=repo_full, auth=auth)
-            
-            # build the manifest URL and make the GET request
-            manifest_url = f"manifests/{tag}"
-            print(f"DEBUG: Requesting manifest at URL: {manifest_url}")
-            response = dxf._request(
-                "get",
-                manifest_url,
-                headers={
-                    "Accept": "application/vnd.docker.distribution.manifest.v1+json"
-                },
-            )
-            print("DEBUG: Response received. Decoding JSON content...")
-            
-            # decode the response content into a Python dictionary.
-            metadata = json.loads(response.content.decode("utf-8"))
-            #print("DEBUG: Metadata decoded successfully:")
-            #print(metadata)
-            # extract the commit hash from the metadata
-            history = metadata.get("history", [])
-            if not history:
-                print("ERROR: No history found in metadata.")
-                return None
-            # check if first history entry contains the v1Compatibility JSON
-            v1compat_str = history[0].get("v1Compatibility")
-            if not v1compat_str:
-                print("ERROR: No v1Compatibility found in the first history entry.")
-                return None
-            v1compat = json.loads(v1compat_str)
-            labels = v1compat.get("config", {}).get("Labels", {})
-            commit = labels.get("org.label-schema.vcs-ref")
-            if commit:
-                print(f"DEBUG: Found commit: {commit}")
+            labels = self.remote_labels(repo_full, tag)
+            if labels is None:
+                print("ERROR: No manifest found for this tag.")
+            elif labels.get(VCS_REF_LABEL):
+                print(f"DEBUG: Found commit: {labels[VCS_REF_LABEL]}")
             else:
-                print("ERROR: Commit label 'org.label-schema.vcs-ref' not found in metadata labels.")
-            return commit
-        except DXFUnauthorizedError as unauthorized:
-            print(f"ERROR: Unauthorized error encountered in last_build_commit - DXFUnauthorizedError: {unauthorized}")
-            #traceback.print_exc()
-            return None
+                print(f"ERROR: Commit label '{VCS_REF_LABEL}' not found in metadata labels.")
+            return labels
         except Exception as e:
-            print(f"ERROR: last_build_commit failed: {e}")
+            print(f"ERROR: last_labels failed: {e}")
             traceback.print_exc()
             return None
 
+    def prefetch_labels(self, namespace, repo_tags, jobs=8):
+        """
+        Fetch the labels of all (repo, tag) pairs concurrently with one
+        bearer token per batch of repositories.
+        Pairs whose lookup fails are left to last_labels.
+        """
+        repo_tags = list(repo_tags)
+        repos = sorted({repo for repo, tag in repo_tags})
+        # warm the token cache: the lookups below then reuse these tokens
+        for i in range(0, len(repos), TOKEN_SCOPE_BATCH):
+            batch = repos[i:i + TOKEN_SCOPE_BATCH]
+            self.bearer_token([f"repository:{namespace}/{repo}:pull" for repo in batch])
 
-    def push_image(self, namespace, repo, tag):
-        try:
-            image = f"{namespace}/{repo}"
-            image_tag = f"{image}:{tag}"
-            print(f"Pushing Docker image {image_tag} ({self.name()})")
+        def fetch(repo_tag):
+            repo, tag = repo_tag
+            try:
+                return True, self.remote_labels(f"{namespace}/{repo}", tag)
+            except Exception as e:
+                print(f"ERROR: prefetch of {namespace}/{repo}:{tag} failed: {e}")
+                return False, None
 
-            # Tagging the image
-            self.client.api.tag(image, image_tag)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            for (repo, tag), (found, labels) in zip(repo_tags, pool.map(fetch, repo_tags)):
+                if found:
+                    self.image_labels[(namespace, repo, tag)] = labels
 
-            # Login to Docker Hub
-            login_response = self.client.login(username=self.username, password=self.password)
-            #print(f"Login successful: {login_response}")
+    def push_image(self, namespace, repo, tag, source=None, stats=None):
+        image = f"{namespace}/{repo}"
+        image_tag = f"{image}:{tag}"
+        print(f"Pushing Docker image {image_tag} ({self.name()})")
 
-            # Push the image
-            push_output = self.client.images.push(repository=image, tag=tag)
-            #print("Push output:", push_output)
+        # Tagging the image
+        self.client.api.tag(source or image, image_tag)
 
-        except BuildError as be:
-            print("Build error occurred: {}".format(be))
-            # Handle build-specific error
-        except APIError as ae:
-            print("API error occurred: {}".format(ae))
-            # Handle API-specific error
-        except TypeError as te:
-            print("Type error: {}".format(te))
-            # Handle type error
-        except Exception as e:
-            print("An unexpected error occurred: {}".format(e))
-            # Handle other exceptions
+        # Push the image, with the credentials of the registry instead of
+        # a new login before each push; failures are raised to the caller
+        return self.stream_push(image, tag, stats)
 
     def get_remote_image_id(self, namespace, image, tag):
         try:
-            url = f"https://hub.docker.com/v2/repositories/{namespace}/{image}/tags/{tag}"
-            resp = requests.get(url, auth=(self.username, self.password))
+            url = f"{self.hub_api}/v2/repositories/{namespace}/{image}/tags/{tag}"
+            resp = self.http.get(url, auth=(self.username, self.password))
             metadata = json.loads(resp.content.decode("utf-8"))
             try:
                 print(f"DEBUG: remote image last pushed: {metadata['images'][0]['last_pushed']}")
@@ -5,8 +5,8 @@ if [ ! -S /var/run/docker.sock ]; then
 			--host=tcp://0.0.0.0:2375 &> /dev/null &
 	DOCKER_PID=$!
 
-	while ! docker info > /dev/null
-	do sleep 1
+	while ! docker info > /dev/null 2>&1
+	do sleep 0.2
 	done
 fi
 
@@ -14,8 +14,16 @@ fi
 git config --global --add safe.directory '*'
 
 chmod u+x /usr/local/bin/*.py
-/usr/local/bin/build.py $@
+/usr/local/bin/build.py $@ &
+BUILD_PID=$!
+# Forward docker stop to the builder (long-running with --watch)
+trap 'kill -TERM ${BUILD_PID} 2> /dev/null' TERM INT
+wait ${BUILD_PID}
 R=$?
+if kill -0 ${BUILD_PID} 2> /dev/null; then
+	wait ${BUILD_PID}
+	R=$?
+fi
 if [ -n "$DOCKER_PID" ]; then
 	kill ${DOCKER_PID}
 fi
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+import copy
+import json
+from os import scandir
+from os.path import dirname, isdir, join
+
+from jsonfile import load_json, save_json
+
+# Fields of a flavor used to build, tag and label its image
+REQUIRED_FIELDS = ["name", "version", "command", "description"]
+
+
+class FlavorError(Exception):
+    pass
+
+
+def validate(flavor):
+    """
+    Return the problems of a flavor manifest, [] if it is valid.
+    """
+    if not isinstance(flavor, dict):
+        return ["not a JSON object"]
+    problems = []
+    for field in REQUIRED_FIELDS:
+        if field not in flavor:
+            problems.append("missing {}".format(field))
+        elif not isinstance(flavor[field], str) or (field != "description" and not flavor[field].strip()):
+            problems.append("invalid {}: {!r}".format(field, flavor[field]))
+    return problems
+
+
+class FlavorIndex:
+    """
+    Flavor manifests (*.json files of the worker directories), read in one
+    pass over the workers and validated. Parsed manifests are persisted
+    between runs, keyed by path, mtime and size, so unchanged files are not
+    read again:
+
+    {"<worker>/<flavor>.json": {"mtime": <ns>, "size": <bytes>, "flavor": {...}, "problems": [...]}}
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.workers = {}
+        self.reads = 0
+        self.entries = load_json(path, "Flavor index", {})
+
+    def entry(self, file):
+        stat = file.stat()
+        entry = self.entries.get(file.path)
+        if entry is not None and entry['mtime'] == stat.st_mtime_ns and entry['size'] == stat.st_size:
+            return entry
+        self.reads += 1
+        try:
+            with open(file.path) as flavor_file:
+                flavor = json.load(flavor_file)
+            problems = validate(flavor)
+        except ValueError as e:
+            flavor, problems = None, ["invalid JSON: {}".format(e)]
+        entry = {'mtime': stat.st_mtime_ns, 'size': stat.st_size, 'flavor': flavor, 'problems': problems}
+        self.entries[file.path] = entry
+        return entry
+
+    def scan(self, base_path, worker_paths):
+        """
+        Index the flavors of the workers. Raise FlavorError, before anything
+        is built, if a manifest is invalid or a flavor name is used twice.
+        """
+        errors = []
+        names = {}
+        entries = {}
+        self.reads = 0
+        for worker_path in worker_paths:
+            flavors = []
+            worker_dir = join(base_path, worker_path)
+            if isdir(worker_dir):
+                with scandir(worker_dir) as files:
+                    for file in sorted(files, key=lambda f: f.name):
+                        if not file.name.endswith('.json') or not file.is_file():
+                            continue
+                        entry = self.entry(file)
+                        entries[file.path] = entry
+                        if entry['problems']:
+                            errors.append('{}: {}'.format(file.path, ', '.join(entry['problems'])))
+                            continue
+                        name = entry['flavor']['name']
+                        if name in names:
+                            errors.append('{}: flavor {} already defined in {}'.format(file.path, name, names[name]))
+                            continue
+                        names[name] = file.path
+                        flavors.append(entry['flavor'])
+            self.workers[worker_path] = flavors
+        # files gone from the scanned workers are dropped from the index
+        scanned = {join(base_path, worker_path) for worker_path in worker_paths}
+        self.entries = {path: entry for path, entry in self.entries.items() if dirname(path) not in scanned}
+        self.entries.update(entries)
+        print('Flavor index: {} flavors in {} workers, {} manifests read'.format(
+            len(names), len(worker_paths), self.reads))
+        if errors:
+            for error in errors:
+                print('Invalid flavor manifest {}'.format(error))
+            raise FlavorError('{} invalid flavor manifests'.format(len(errors)))
+
+    def flavors(self, worker_path):
+        """
+        Flavors of a worker, as new dicts the caller may modify.
+        """
+        return copy.deepcopy(self.workers.get(worker_path, []))
+
+    def save(self):
+        if self.path is None:
+            return
+        save_json(self.path, self.entries)
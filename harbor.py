@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import json
-import requests
 from registry import Registry
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE = 100
 
 
 class Harbor(Registry):
@@ -13,36 +15,107 @@ class Harbor(Registry):
     def name(self):
         return "harbor"
 
-    def last_build_commit(self, namespace, repo, tag):
+    def last_labels(self, namespace, repo, tag):
         try:
-            resp = requests.get(
+            resp = self.http.get(
                 # 'https://{}/api/repositories/{}/{}/tags/{}/manifest'.format(self.registry, namespace, repo, tag),
                 # Harbor API v2.0 
-                'https://{}/api/v2.0/projects/{}/repositories/{}/artifacts/{}'.format(
-                    self.registry, namespace, repo, tag),
+                '{}://{}/api/v2.0/projects/{}/repositories/{}/artifacts/{}'.format(
+                    self.scheme, self.registry, namespace, repo, tag),
                 auth=(self.username, self.password))
 
             metadata = json.loads(resp.content.decode('utf-8'))
             # return json.loads(metadata['config'])['config']['Labels']['org.label-schema.vcs-ref']
             # Harbor API v2.0 
-            return metadata['extra_attrs']['config']['Labels']['org.label-schema.vcs-ref']
+            return metadata['extra_attrs']['config']['Labels']
 
         except Exception as e:
-            print("last_build_commit failed: {}".format(e))
+            print("last_labels failed: {}".format(e))
             return None
 
-    def push_image(self, namespace, repo, tag):
+    def paginate(self, url, **params):
+        page = 1
+        while True:
+            resp = self.http.get(url, params=dict(params, page=page, page_size=PAGE_SIZE),
+                                 auth=(self.username, self.password))
+            resp.raise_for_status()
+            items = resp.json()
+            yield from items
+            if len(items) < PAGE_SIZE:
+                return
+            page += 1
+
+    def prefetch_labels(self, namespace, repo_tags, jobs=8):
+        """
+        Fetch the labels of all (repo, tag) pairs using the paginated listings
+        of the project: repositories first, then the artifacts of each
+        candidate repository, concurrently.
+        """
+        repo_tags = list(repo_tags)
+        api = '{}://{}/api/v2.0/projects/{}'.format(self.scheme, self.registry, namespace)
+        existing = {repository['name'].split('/', 1)[-1]
+                    for repository in self.paginate('{}/repositories'.format(api))}
+
+        def fetch(repo):
+            labels = {}
+            for artifact in self.paginate('{}/repositories/{}/artifacts'.format(api, repo), with_tag='true'):
+                artifact_labels = ((artifact.get('extra_attrs') or {}).get('config') or {}).get('Labels') or {}
+                for tag in artifact.get('tags') or []:
+                    labels[tag['name']] = artifact_labels
+            return labels
+
+        repos = sorted({repo for repo, tag in repo_tags if repo in existing})
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            futures = {repo: pool.submit(fetch, repo) for repo in repos}
+        for repo, tag in repo_tags:
+            if repo not in existing:
+                self.image_labels[(namespace, repo, tag)] = None
+                continue
+            try:
+                self.image_labels[(namespace, repo, tag)] = futures[repo].result().get(tag)
+            except Exception as e:
+                # left to last_labels
+                print('prefetch of {}/{}:{} failed: {}'.format(namespace, repo, tag, e))
+
+    def push_image(self, namespace, repo, tag, source=None, stats=None):
         image = '{}/{}'.format(namespace, repo)
         image_tag = '{}/{}:{}'.format(self.registry, image, tag)
         print('Push Docker image {} on harbor ({})'.format(image_tag, self.name()))
-        self.client.api.tag(image, image_tag)
-        image = '{}/{}/{}'.format(self.registry, namespace, repo)
-        self.client.images.push(image, tag=tag)
+        self.client.api.tag(source or image, image_tag)
+        return self.stream_push('{}/{}/{}'.format(self.registry, namespace, repo), tag, stats)
+
+    def retag_image(self, namespace, repo, reference, new_tag):
+        # Harbor API v2.0: add a tag to the artifact
+        api = '{}://{}/api/v2.0/projects/{}/repositories/{}/artifacts'.format(
+            self.scheme, self.registry, namespace, repo)
+        resp = self.http.post('{}/{}/tags'.format(api, reference), json={'name': new_tag},
+                              auth=(self.username, self.password))
+        if resp.status_code == 409:
+            # the tag is on the previous artifact: move it
+            self.http.delete('{}/{}/tags/{}'.format(api, new_tag, new_tag),
+                             auth=(self.username, self.password)).raise_for_status()
+            resp = self.http.post('{}/{}/tags'.format(api, reference), json={'name': new_tag},
+                                  auth=(self.username, self.password))
+        resp.raise_for_status()
+
+    def remote_digest(self, namespace, repo, tag):
+        # Harbor API v2.0 with basic authentication: one request, no token
+        key = (namespace, repo, tag)
+        if key not in self.remote_digests:
+            resp = self.http.get('{}://{}/api/v2.0/projects/{}/repositories/{}/artifacts/{}'.format(
+                self.scheme, self.registry, namespace, repo, tag), auth=(self.username, self.password))
+            if resp.status_code == 404:
+                self.remote_digests[key] = None
+            else:
+                resp.raise_for_status()
+                self.remote_digests[key] = resp.json()['digest']
+        return self.remote_digests[key]
 
     def get_remote_image_id(self, namespace, repo, tag):
         try:
-            resp = requests.get(
-                'https://{}/api/v2.0/projects/{}/repositories/{}/artifacts?q=tags={}'.format(self.registry, namespace, repo, tag),
+            resp = self.http.get(
+                '{}://{}/api/v2.0/projects/{}/repositories/{}/artifacts?q=tags={}'.format(
+                    self.scheme, self.registry, namespace, repo, tag),
                 auth=(self.username, self.password))
 
             metadata = json.loads(resp.content.decode('utf-8'))
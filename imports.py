@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+
+import ast
+import io
+import json
+import re
+import sys
+import tarfile
+import time
+from os.path import basename, dirname, isdir, isfile, join
+
+import requests
+
+# Seconds given to the in-container import check
+IMPORT_TEST_TIMEOUT = 120
+# Import names of distributions not importable under their own name
+IMPORT_NAMES = {
+    "beautifulsoup4": "bs4",
+    "dnspython": "dns",
+    "msgpack_python": "msgpack",
+    "opencv_python": "cv2",
+    "pillow": "PIL",
+    "protobuf": "google",
+    "pycryptodome": "Crypto",
+    "pycryptodomex": "Cryptodome",
+    "pyopenssl": "OpenSSL",
+    "python_dateutil": "dateutil",
+    "python_json_logger": "pythonjsonlogger",
+    "python_magic": "magic",
+    "python_whois": "whois",
+    "pyyaml": "yaml",
+    "scikit_learn": "sklearn",
+    "setuptools": "pkg_resources",
+    "attrs": "attr",
+}
+# Pure python distributions loading a native library at import (ctypes, cffi):
+# installing them is not enough, the library must be in the image
+NATIVE_LIBRARY_DISTRIBUTIONS = {"python_magic", "pyzbar", "cairocffi", "weasyprint", "pylibdmtx"}
+# Standard library modules removed by the Python versions of the base images
+# (3.12, 3.13): possibly still in the Python running the builder
+REMOVED_STDLIB_MODULES = {
+    "asynchat", "asyncore", "distutils", "imp", "smtpd",
+    "aifc", "audioop", "cgi", "cgitb", "chunk", "crypt", "imghdr", "lib2to3", "mailcap", "msilib", "nis",
+    "nntplib", "ossaudiodev", "pipes", "sndhdr", "spwd", "sunau", "telnetlib", "uu", "xdrlib",
+}
+
+# Run in the image: import every module imported by the entrypoint and print
+# the failures as JSON on the last line
+CHECK_SCRIPT = r'''
+import importlib, json, os, sys
+import os.path as osp
+config = json.loads(sys.argv[1])
+entrypoint = config["command"]
+if "/" in entrypoint:
+    directory = osp.dirname(entrypoint)
+    # the worker folder is the fallback when the directory of the command is not found
+    if not osp.isdir(directory) and osp.isdir(config["worker"]):
+        directory = config["worker"]
+    os.chdir(directory)
+    entrypoint = osp.basename(entrypoint)
+if not osp.exists(entrypoint):
+    print(json.dumps({"error": "{} not found inside the container".format(entrypoint)}))
+    sys.exit(1)
+sys.path.insert(0, os.getcwd())
+imports = config["imports"]
+if imports is None:
+    # not analyzed on the host
+    import ast
+    imports = []
+    for node in ast.parse(open(entrypoint).read()).body:
+        if isinstance(node, ast.Import):
+            imports += [(alias.name, []) for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            imports.append((node.module, [alias.name for alias in node.names if alias.name != "*"]))
+failed = {}
+for module, names in imports:
+    try:
+        imported = importlib.import_module(module)
+        for name in names:
+            if not hasattr(imported, name):
+                importlib.import_module("{}.{}".format(module, name))
+    except BaseException as e:
+        failed[module] = "{}: {}".format(type(e).__name__, e)
+print(json.dumps({"failed": failed}))
+'''
+
+# Run in the image: time of the interpreter start, of the first import of the
+# entrypoint and of the end of its module-level imports
+STARTUP_SCRIPT = r'''
+import time
+started = time.time()
+import importlib, json, os, sys
+import os.path as osp
+config = json.loads(sys.argv[1])
+directory = osp.dirname(config["command"])
+if directory and not osp.isdir(directory) and osp.isdir(config["worker"]):
+    directory = config["worker"]
+if directory:
+    os.chdir(directory)
+sys.path.insert(0, os.getcwd())
+first_import = None
+for module, names in config["imports"]:
+    try:
+        importlib.import_module(module)
+    except BaseException:
+        pass
+    if first_import is None:
+        first_import = time.time()
+print(json.dumps({"started": started, "first_import": first_import or time.time(), "imports": time.time()}))
+'''
+
+
+def normalize(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def entrypoint_imports(path):
+    """
+    Modules imported at module level by the entrypoint, as (module, names)
+    pairs, names being the names of `from module import names`. Imports
+    nested in try/if blocks are optional and relative imports are local:
+    both are left out.
+    """
+    with open(path, encoding='utf-8') as entrypoint:
+        tree = ast.parse(entrypoint.read(), path)
+    imports = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports += [(alias.name, []) for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            imports.append((node.module, [alias.name for alias in node.names if alias.name != '*']))
+    return imports
+
+
+def dependency_conflict(build_lines):
+    """
+    Whether pip reported a dependency conflict in the build output: any
+    installed distribution can then be broken.
+    """
+    return any("dependency resolver does not currently take into account" in line or
+               re.search(r'has requirement .+, but you have', line) for line in build_lines)
+
+
+def site_packages(image):
+    """
+    site-packages directory of the Python of an image built from the
+    official python images (PYTHON_VERSION in its environment), else None.
+    """
+    for variable in (image.attrs.get('Config') or {}).get('Env') or []:
+        name, _, value = variable.partition('=')
+        if name == 'PYTHON_VERSION':
+            return '/usr/local/lib/python{}/site-packages'.format('.'.join(value.split('.')[:2]))
+    return None
+
+
+class ChunkReader(io.RawIOBase):
+    """
+    Readable file over the chunks of a docker API stream.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.chunk:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                return 0
+            self.chunk = memoryview(chunk)
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+
+def pure_python_modules(archive):
+    """
+    Normalized import names of the pure python distributions of a
+    site-packages archive, from their *.dist-info (Root-Is-Purelib in WHEEL,
+    top_level.txt). Distributions with compiled extensions, installed
+    without a wheel (*.egg-info) or loading a native library can still fail
+    to import (missing library on alpine, musl wheel ABI...): none of these
+    is resolved, nor the modules they share with a pure one.
+    """
+    distributions = {}
+    with tarfile.open(fileobj=archive, mode='r|') as tar:
+        for member in tar:
+            parts = member.name.split('/')
+            if len(parts) != 3 or not member.isfile() or parts[2] not in ('WHEEL', 'top_level.txt'):
+                continue
+            if not parts[1].endswith('.dist-info'):
+                continue
+            distribution = distributions.setdefault(normalize(parts[1].split('-', 1)[0]),
+                                                    {'purelib': False, 'modules': set()})
+            content = tar.extractfile(member).read().decode('utf-8', 'replace')
+            if parts[2] == 'WHEEL':
+                distribution['purelib'] = bool(re.search(r'^Root-Is-Purelib:\s*true\s*$', content, re.M | re.I))
+            else:
+                distribution['modules'] = {normalize(line) for line in content.split() if line}
+    modules = set()
+    other = set()
+    for name, distribution in distributions.items():
+        names = distribution['modules'] or {name, normalize(IMPORT_NAMES.get(name, name))}
+        if distribution['purelib'] and name not in NATIVE_LIBRARY_DISTRIBUTIONS:
+            modules |= names
+        else:
+            other |= names
+    return modules - other
+
+
+class ImportVerifier:
+    """
+    Check that the modules imported by the entrypoint of a flavor are
+    importable in its image.
+
+    The imports are first checked statically, on the host, against the
+    standard library, the local modules of the worker and the pure python
+    distributions installed in the image, read from its site-packages
+    (whether the pip step of the build was cached or not) through a created,
+    never started, container. Only when this is inconclusive (e.g. a
+    distribution with compiled extensions) is a container started, once per
+    image, to import all of them, with a timeout.
+    """
+
+    def __init__(self, client, timeout=IMPORT_TEST_TIMEOUT):
+        self.client = client
+        self.timeout = timeout
+
+    def entrypoint(self, base_path, worker_path, command):
+        path = join(base_path, dirname(worker_path), command)
+        if isfile(path):
+            return path
+        path = join(base_path, worker_path, basename(command))
+        return path if isfile(path) else None
+
+    def unresolved(self, imports, local_dirs, installed):
+        stdlib = (set(getattr(sys, 'stdlib_module_names', ())) | set(sys.builtin_module_names)) - \
+            REMOVED_STDLIB_MODULES
+        unresolved = []
+        for module, names in imports:
+            top = module.split('.', 1)[0]
+            if top in stdlib or normalize(top) in installed:
+                continue
+            if any(isfile(join(d, top + '.py')) or isdir(join(d, top)) for d in local_dirs):
+                continue
+            unresolved.append(module)
+        return unresolved
+
+    def verify(self, image_tag, base_path, worker_path, flavor, build_lines):
+        """
+        Result of the check: {"method": "static" or "container", "status":
+        "ok", "failed", "timeout" or "error", "imports": n, ...}.
+        """
+        path = self.entrypoint(base_path, worker_path, flavor['command'])
+        imports = None
+        if path is not None:
+            try:
+                imports = entrypoint_imports(path)
+            except (SyntaxError, ValueError) as e:
+                # may be valid for the Python of the image
+                print("Static import analysis of {} failed: {}".format(flavor['command'], e))
+        if imports is not None:
+            local_dirs = {dirname(path), join(base_path, worker_path)}
+            unresolved = self.unresolved(imports, local_dirs, set())
+            if unresolved and not dependency_conflict(build_lines):
+                unresolved = self.unresolved(imports, local_dirs, self.installed(image_tag))
+            if not unresolved:
+                return {'method': 'static', 'status': 'ok', 'imports': len(imports)}
+            print("Imports not resolved statically: {}".format(', '.join(unresolved)))
+        result = self.run(image_tag, flavor['command'], basename(worker_path), imports)
+        result.update(method='container', imports=len(imports) if imports is not None else None)
+        return result
+
+    def installed(self, image_tag):
+        """
+        Import names of the pure python distributions installed in the image
+        (see pure_python_modules), empty when they cannot be read.
+        """
+        try:
+            path = site_packages(self.client.images.get(image_tag))
+            if path is None:
+                return set()
+            container = self.client.containers.create(image_tag, entrypoint='true')
+            try:
+                stream, stat = container.get_archive(path)
+                return pure_python_modules(io.BufferedReader(ChunkReader(stream), 1024 * 1024))
+            finally:
+                container.remove(force=True)
+        except Exception as e:
+            print("Installed distributions of {} not read: {}".format(image_tag, e))
+            return set()
+
+    def execute(self, image_tag, script, config):
+        """
+        Run a python script in a container of the image, with config as JSON
+        argument, and return the JSON printed on its last line as "output",
+        with the status "ok", or the status "timeout" or "error".
+        """
+        container = self.client.containers.run(image_tag, entrypoint='python',
+                                               command=['-c', script, json.dumps(config)], detach=True)
+        try:
+            try:
+                container.wait(timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                container.kill()
+                return {'status': 'timeout'}
+            lines = container.logs(stdout=True, stderr=False).decode('utf-8', 'replace').strip().splitlines()
+            try:
+                return {'status': 'ok', 'output': json.loads(lines[-1])}
+            except (IndexError, ValueError):
+                return {'status': 'error', 'error': container.logs(stdout=False, stderr=True)
+                        .decode('utf-8', 'replace').strip()[-500:]}
+        finally:
+            container.remove(force=True)
+
+    def run(self, image_tag, command, worker_name, imports):
+        """
+        Import every module in a single run of the image.
+        """
+        result = self.execute(image_tag, CHECK_SCRIPT, {'command': command, 'worker': worker_name,
+                                                        'imports': imports})
+        if result['status'] != 'ok':
+            return result
+        output = result['output']
+        if 'error' in output:
+            return {'status': 'error', 'error': output['error']}
+        if output['failed']:
+            return {'status': 'failed', 'failed': output['failed']}
+        return {'status': 'ok'}
+
+    def startup_time(self, image_tag, base_path, worker_path, flavor):
+        """
+        Time from the start of a container of the image to the first import
+        of the entrypoint (and to the end of its module-level imports), as
+        seen by a Cortex job, in seconds.
+        """
+        path = self.entrypoint(base_path, worker_path, flavor['command'])
+        try:
+            imports = entrypoint_imports(path) if path is not None else []
+        except (SyntaxError, ValueError):
+            imports = []
+        start = time.time()
+        result = self.execute(image_tag, STARTUP_SCRIPT, {'command': flavor['command'],
+                                                          'worker': basename(worker_path), 'imports': imports})
+        if result['status'] != 'ok':
+            return result
+        times = result['output']
+        return {
+            'status': 'ok',
+            'interpreter': round(times['started'] - start, 3),
+            'first_import': round(times['first_import'] - start, 3),
+            'imports': round(times['imports'] - start, 3),
+        }
@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+
+import json
+from contextlib import contextmanager
+from os import makedirs, replace
+from os.path import dirname, isfile
+
+
+def load_json(path, description, default):
+    """
+    Content of the JSON file path, or default when there is no such file or
+    when it can't be read (printed as "<description> <path> ignored").
+    """
+    if path is None or not isfile(path):
+        return default
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except Exception as e:
+        print("{} {} ignored: {}".format(description, path, e))
+        return default
+
+
+@contextmanager
+def atomic_write(path):
+    """
+    Text file to write path: a temporary file next to it, replacing it once
+    written, so that readers (e.g. other runners sharing the cache
+    directory) never see a partial file.
+    """
+    makedirs(dirname(path) or '.', exist_ok=True)
+    with open(path + '.tmp', 'w') as tmp_file:
+        yield tmp_file
+    replace(path + '.tmp', path)
+
+
+def save_json(path, data, **kwargs):
+    """
+    Write data to the JSON file path atomically (see atomic_write), kwargs
+    being given to json.dump.
+    """
+    with atomic_write(path) as json_file:
+        json.dump(data, json_file, **kwargs)
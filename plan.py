@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import statistics
+from collections import Counter
+from os.path import basename
+
+from jsonfile import save_json
+
+PLAN_VERSION = 1
+# Phases of a flavor in the run report making the estimates of its nodes
+BUILD_PHASES = ["base_image", "build", "import_test", "startup_probe"]
+PUSH_PHASES = ["push", "tag", "verification"]
+SHARED_LAYERS_NODE = "shared-layers"
+
+
+class PlanError(Exception):
+    pass
+
+
+def push_tags(version, stable):
+    """
+    Tags a flavor is pushed with: its version (devel when not stable) and
+    the major version.
+    """
+    tag = version if stable else 'devel'
+    return [tag, tag.split('.', 1)[0]] if '.' in tag else [tag]
+
+
+class BuildPlan:
+    """
+    What a run does, computed by --plan without building nor pushing: the
+    flavors to build and their base image, the registries and tags each one
+    is pushed to, the ones skipped and why, as a DAG of build and push nodes
+    with durations estimated from the previous run report and the duration
+    history.
+
+    Saved as JSON, a plan is executed by a later run on the same commit
+    (--execute-plan), without the flavor discovery and the remote lookups.
+    Images pushed in the meantime by another run are not seen.
+    """
+
+    def __init__(self, commit, namespace, stable, registries, force=False, shard=None):
+        self.version = PLAN_VERSION
+        self.created = datetime.datetime.now().isoformat('T') + 'Z'
+        self.commit = commit
+        self.namespace = namespace
+        self.stable = stable
+        self.registries = registries
+        self.force = force
+        self.shard = shard
+        # partition of the shard, written in its summary
+        self.partition = None
+        self.workers = []
+        # flavor name -> {"worker", "manifest", "base", "shared_layers", "push": {registry: tags},
+        # "skip": {registry: reason}}
+        self.flavors = {}
+        # dependency sets of the shared layer images
+        self.shared_layers = []
+        self.nodes = []
+        self.estimate = {}
+
+    def add(self, worker_path, flavor, base, push, skip, shared_layers=None):
+        if worker_path not in self.workers:
+            self.workers.append(worker_path)
+        self.flavors[flavor['name']] = {
+            'worker': worker_path,
+            'manifest': flavor,
+            'base': base,
+            'shared_layers': shared_layers,
+            'push': {registry: push_tags(flavor['version'], self.stable) for registry in push},
+            'skip': skip,
+        }
+
+    def flavors_of(self, worker_path):
+        """
+        (flavor, registries to push to, {registry: skip reason}) of the
+        flavors of a worker, in plan order.
+        """
+        return [(dict(entry['manifest']), list(entry['push']), entry['skip'])
+                for entry in self.flavors.values() if entry['worker'] == worker_path]
+
+    def build_nodes(self, previous, history, jobs, push_jobs, shared_layers_time=None):
+        """
+        Nodes of the DAG, each with its estimated duration in seconds and
+        the source of the estimate: "report" (same node in the previous run
+        report), "history" (share of the last duration of the worker) or
+        "median" (median push of the previous run).
+        """
+        pushes = [sum(times.get(phase, 0) for phase in PUSH_PHASES)
+                  for record in previous.values() for times in record.get('registries', {}).values()
+                  if any(phase in times for phase in PUSH_PHASES)]
+        push_median = statistics.median(pushes) if pushes else 0.0
+        per_worker = {}
+        for entry in self.flavors.values():
+            per_worker[entry['worker']] = per_worker.get(entry['worker'], 0) + 1
+
+        self.nodes = []
+        if self.shared_layers and any(entry['push'] for entry in self.flavors.values()):
+            self.nodes.append({'id': SHARED_LAYERS_NODE, 'kind': 'shared_layers', 'after': [],
+                               'sets': self.shared_layers, 'estimate': shared_layers_time or 0.0,
+                               'source': 'report' if shared_layers_time is not None else None})
+        shared = bool(self.nodes)
+        for name, entry in self.flavors.items():
+            if not entry['push']:
+                continue
+            record = previous.get(name, {})
+            phases = record.get('phases', {}) if record.get('status') == 'built' else {}
+            build = sum(phases.get(phase, 0) for phase in BUILD_PHASES)
+            source = 'report'
+            if not build:
+                build = history.estimate(basename(entry['worker'])) / per_worker[entry['worker']]
+                source = 'history'
+            build_id = 'build:{}'.format(name)
+            self.nodes.append({
+                'id': build_id, 'kind': 'build', 'flavor': name, 'worker': entry['worker'],
+                'base': entry['base'], 'shared_layers': entry['shared_layers'],
+                'after': [SHARED_LAYERS_NODE] if shared and entry['shared_layers'] else [],
+                'estimate': round(build, 3), 'source': source,
+            })
+            for registry, tags in entry['push'].items():
+                times = record.get('registries', {}).get(registry, {})
+                push = sum(times.get(phase, 0) for phase in PUSH_PHASES)
+                self.nodes.append({
+                    'id': 'push:{}@{}'.format(name, registry), 'kind': 'push', 'flavor': name,
+                    'registry': registry, 'image': '{}/{}'.format(self.namespace, name.lower()), 'tags': tags,
+                    'after': [build_id], 'estimate': round(push or push_median, 3),
+                    'source': 'report' if push else 'median',
+                })
+
+        # Approximate wall time: the longest chain, or the builds and pushes
+        # spread on their workers when these take longer
+        estimates = {node['id']: node['estimate'] for node in self.nodes}
+        finish = {}
+        for node in self.nodes:
+            finish[node['id']] = node['estimate'] + max((finish[n] for n in node['after']), default=0.0)
+        builds = sum(node['estimate'] for node in self.nodes if node['kind'] == 'build')
+        pushes = sum(node['estimate'] for node in self.nodes if node['kind'] == 'push')
+        self.estimate = {
+            'total': round(sum(estimates.values()), 3),
+            'wall': round(max([max(finish.values(), default=0.0), builds / max(1, jobs),
+                               pushes / max(1, push_jobs)]) + estimates.get(SHARED_LAYERS_NODE, 0.0), 3),
+            'jobs': jobs,
+            'push_jobs': push_jobs,
+        }
+
+    def check(self, commit, namespace, stable, registries):
+        """
+        Raise PlanError if the plan was not computed for this commit and
+        these options.
+        """
+        if self.commit != commit:
+            raise PlanError('plan computed for commit {}, not for the current commit {}'.format(self.commit, commit))
+        if self.namespace != namespace or self.stable != stable:
+            raise PlanError('plan computed for {} ({}), not for {} ({})'.format(
+                self.namespace, 'stable' if self.stable else 'devel', namespace, 'stable' if stable else 'devel'))
+        missing = sorted(set(self.registries) - set(registries))
+        if missing:
+            raise PlanError('registries of the plan not configured: {}'.format(', '.join(missing)))
+
+    def display(self):
+        builds = [node for node in self.nodes if node['kind'] == 'build']
+        pushes = [node for node in self.nodes if node['kind'] == 'push']
+        skipped = sum(len(entry['skip']) for entry in self.flavors.values())
+        print('Plan for commit {}: {} flavors to build, {} pushes, {} skipped'
+              .format(self.commit[:12], len(builds), len(pushes), skipped))
+        for node in self.nodes:
+            if node['kind'] == 'shared_layers':
+                print('  shared layers: {} dependency sets  ~{:.1f}s'.format(len(node['sets']), node['estimate']))
+            elif node['kind'] == 'build':
+                print('  build {} ({}) on {}{}  ~{:.1f}s ({})'.format(
+                    node['flavor'], node['worker'], node['base'], ' + shared layers' if node['shared_layers'] else '',
+                    node['estimate'], node['source']))
+            else:
+                print('    push {}:{} to {}  ~{:.1f}s ({})'.format(
+                    node['image'], ','.join(node['tags']), node['registry'], node['estimate'], node['source']))
+        # skipped flavors grouped by reason, each one is in the plan file
+        reasons = Counter(reason for entry in self.flavors.values() for reason in entry['skip'].values())
+        for reason, count in sorted(reasons.items(), key=lambda item: (-item[1], item[0])):
+            print('  skip {} flavor pushes: {}'.format(count, reason))
+        print('Estimated duration: {:.1f}s of work, about {:.1f}s with {} build jobs and {} push jobs'.format(
+            self.estimate['total'], self.estimate['wall'], self.estimate['jobs'], self.estimate['push_jobs']))
+
+    def to_dict(self):
+        return {
+            'version': self.version, 'created': self.created, 'commit': self.commit, 'namespace': self.namespace,
+            'stable': self.stable, 'registries': self.registries, 'force': self.force,
+            'shard': None if self.shard is None else '{}/{}'.format(*self.shard), 'partition': self.partition,
+            'workers': self.workers, 'shared_layers': self.shared_layers, 'flavors': self.flavors,
+            'nodes': self.nodes, 'estimate': self.estimate,
+        }
+
+    def save(self, path):
+        save_json(path, self.to_dict(), indent=2)
+        print('Plan written to {}'.format(path))
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as plan_file:
+                data = json.load(plan_file)
+        except (OSError, ValueError) as e:
+            raise PlanError('plan {} not readable: {}'.format(path, e))
+        if data.get('version') != PLAN_VERSION:
+            raise PlanError('plan {} has version {}, expected {}'.format(path, data.get('version'), PLAN_VERSION))
+        shard = data['shard']
+        plan = cls(data['commit'], data['namespace'], data['stable'], data['registries'], data['force'],
+                   None if shard is None else tuple(int(part) for part in shard.split('/')))
+        plan.created = data['created']
+        plan.partition = data.get('partition')
+        plan.workers = data['workers']
+        plan.shared_layers = data['shared_layers']
+        plan.flavors = data['flavors']
+        plan.nodes = data['nodes']
+        plan.estimate = data['estimate']
+        return plan
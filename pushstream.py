@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import re
+import time
+
+# Status of a layer of the push stream once it is on the registry
+PUSHED = "Pushed"
+EXISTING = "Layer already exists"
+MOUNTED = "Mounted from"
+
+
+class PushStream:
+    """
+    Progress of a push, followed on the decoded stream of the Docker daemon:
+    status, bytes sent and push time of each layer, the error if the push
+    failed and the manifest digest.
+    """
+
+    def __init__(self, repository, tag):
+        self.repository = repository
+        self.tag = tag
+        self.layers = {}
+        self.digest = None
+        self.error = None
+        self.start = time.monotonic()
+        self.end = None
+
+    def update(self, event):
+        now = time.monotonic()
+        if 'error' in event or 'errorDetail' in event:
+            self.error = event.get('error') or event['errorDetail'].get('message')
+            return
+        if 'aux' in event:
+            self.digest = (event['aux'] or {}).get('Digest', self.digest)
+            return
+        status = event.get('status', '')
+        if 'id' not in event:
+            # "<tag>: digest: sha256:... size: ..." before the aux event
+            match = re.search(r'digest: (sha256:[0-9a-f]{64})', status)
+            if match:
+                self.digest = self.digest or match.group(1)
+            return
+        layer = self.layers.setdefault(event['id'], {'status': None, 'bytes': 0, 'total': None,
+                                                     'started': None, 'finished': None, 'retries': 0})
+        layer['status'] = status
+        if status == 'Pushing':
+            detail = event.get('progressDetail') or {}
+            layer['started'] = layer['started'] or now
+            layer['bytes'] = detail.get('current', layer['bytes'])
+            layer['total'] = detail.get('total', layer['total'])
+        elif status.startswith('Retrying'):
+            layer['retries'] += 1
+        elif status == PUSHED or status == EXISTING or status.startswith(MOUNTED):
+            layer['finished'] = now
+            if status == PUSHED and layer['total']:
+                layer['bytes'] = layer['total']
+
+    def follow(self, events):
+        """
+        Consume the events of the push, printing each layer once done.
+        """
+        for event in events:
+            self.update(event)
+            if event.get('id') in self.layers and self.layers[event['id']]['finished'] is not None and \
+                    event.get('status') != 'Pushing':
+                layer = self.layers[event['id']]
+                print(' > {}: {}{}'.format(event['id'], layer['status'],
+                                           ' ({} bytes)'.format(layer['bytes']) if layer['status'] == PUSHED else ''))
+        self.end = time.monotonic()
+        return self
+
+    def failed_layers(self):
+        return sorted(layer_id for layer_id, layer in self.layers.items() if layer['finished'] is None)
+
+    def summary(self):
+        """
+        {"digest", "pushed", "existing", "mounted", "bytes", "seconds",
+        "throughput" (bytes/s), "layers": {id: {"bytes", "seconds"}}} of the
+        layers sent.
+        """
+        seconds = (self.end or time.monotonic()) - self.start
+        pushed = {layer_id: layer for layer_id, layer in self.layers.items() if layer['status'] == PUSHED}
+        sent = sum(layer['bytes'] for layer in pushed.values())
+        return {
+            'digest': self.digest,
+            'pushed': len(pushed),
+            'existing': sum(1 for layer in self.layers.values() if layer['status'] == EXISTING),
+            'mounted': sum(1 for layer in self.layers.values() if (layer['status'] or '').startswith(MOUNTED)),
+            'bytes': sent,
+            'seconds': round(seconds, 3),
+            'throughput': round(sent / seconds) if seconds > 0 else None,
+            'layers': {layer_id: {'bytes': layer['bytes'],
+                                  'seconds': round(layer['finished'] - (layer['started'] or self.start), 3),
+                                  'retries': layer['retries']}
+                       for layer_id, layer in pushed.items()},
+        }
@@ -4,10 +4,55 @@ import traceback
 import datetime
 from os.path import isfile, join, basename
 import tempfile
-from docker.errors import BuildError
-import subprocess
-import textwrap
+from docker.errors import APIError, BuildError
 import re
+import json
+import hashlib
+import threading
+import time
+import requests
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from basecache import requirements_hash
+from wheelhouse import WHEELS_STAGE, CONTEXT_WORKER, CONTEXT_WHEELHOUSE
+from report import RunReport
+from imports import ImportVerifier
+from buildcontext import BuildContext, context_size
+from pushstream import PushStream
+
+HTTP_POOL_SIZE = 16
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.5
+# Renew bearer tokens a bit before they expire
+TOKEN_EXPIRY_MARGIN = 10
+# Pushes of an image, the layers already sent being skipped by the daemon
+PUSH_ATTEMPTS = 3
+PUSH_RETRY_DELAY = 2
+
+VCS_REF_LABEL = "org.label-schema.vcs-ref"
+# sha256 of the git tree of the worker directory and of the generated Dockerfiles
+CONTENT_HASH_LABEL = "org.thehive-project.content-hash"
+
+# Base images tried, in order, for workers without Dockerfile
+BASE_IMAGES = ["python:3-alpine", "python:3-slim", "python:3"]
+
+# List of workers that need a special Alpine setup to support libmagic
+# --> not developped correctly to support single Dockerfile in repository (multiple .py entrypoint file)
+SPECIAL_ALPINE_WORKERS = ["PaloAltoNGFW"]
+
+# Stage of the optimized generated Dockerfile where dependencies are installed
+# and python files compiled
+BUILDER_STAGE = "builder"
+# Bytecode not checked against the sources at import: the image never changes.
+# Files that don't compile (python 2 tests of some packages...) are skipped.
+COMPILEALL = "python -m compileall -q -j 0 --invalidation-mode unchecked-hash"
+
+MANIFEST_TYPES = ", ".join([
+    "application/vnd.docker.distribution.manifest.v2+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.oci.image.index.v1+json",
+])
 
 class Registry:
     def __init__(self, client, registry_string, default_registry):
@@ -17,6 +62,22 @@ class Registry:
             self.registry = registry_string.split("@")[1]
             self.client = client
             self.default_registry = default_registry
+            # URL scheme of the registry APIs (http for local registries)
+            self.scheme = "https"
+            # (namespace, repo, tag) -> labels of the published image (None if
+            # not published), filled by prefetch_labels before the build loop
+            self.image_labels = {}
+            # (namespace, repo, tag) -> manifest digest on the registry, looked
+            # up once after a push
+            self.remote_digests = {}
+            # keep-alive session and bearer tokens shared by all API calls
+            self.http = self.session()
+            self.challenge = None
+            self.challenge_lock = threading.Lock()
+            self.tokens = {}
+            self.tokens_lock = threading.Lock()
+            # optional engine pushing through the registry API (BlobPusher)
+            self.push_engine = None
         except Exception as e:
             print("Exception: " + str(e))
             print("Wrong format in the registry credentials")
@@ -34,168 +95,515 @@ class Registry:
             print("Login failed: {}".format(e))
             raise e
 
-    def last_build_commit(self, namespace, repo, tag):
+    def last_labels(self, namespace, repo, tag):
+        """
+        Labels of the published image namespace/repo:tag, None if not found.
+        """
         return None
 
-    def test_imports(self, image_tag, command, worker_name):
+    def published_labels(self, namespace, repo, tag):
+        key = (namespace, repo, tag)
+        if key not in self.image_labels:
+            self.image_labels[key] = self.last_labels(namespace, repo, tag)
+        return self.image_labels[key]
+
+    def build_commit(self, namespace, repo, tag):
+        labels = self.published_labels(namespace, repo, tag)
+        return None if labels is None else labels.get(VCS_REF_LABEL)
+
+    def build_content_hash(self, namespace, repo, tag):
+        labels = self.published_labels(namespace, repo, tag)
+        return None if labels is None else labels.get(CONTENT_HASH_LABEL)
+
+    def prefetch_labels(self, namespace, repo_tags, jobs=8):
+        """
+        Fetch the labels of every (repo, tag) pair concurrently, so that
+        build_commit and build_content_hash are in-memory lookups during the
+        build loop. Registries with a bulk API override this method.
+        """
+        repo_tags = list(repo_tags)
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            labels = pool.map(lambda repo_tag: self.last_labels(namespace, *repo_tag), repo_tags)
+            for (repo, tag), image_labels in zip(repo_tags, labels):
+                self.image_labels[(namespace, repo, tag)] = image_labels
+
+    def session(self, pool_size=HTTP_POOL_SIZE):
+        """
+        Keep-alive session with retry and exponential backoff on connection
+        errors, rate limiting and 5xx responses.
+        """
+        session = requests.Session()
+        retry = Retry(
+            total=HTTP_RETRIES,
+            backoff_factor=HTTP_BACKOFF,
+            status_forcelist=(429, 500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def auth_challenge(self):
+        """
+        Parameters (realm, service) of the bearer challenge of the registry,
+        or {} if it does not use token authentication. Fetched once.
+        """
+        with self.challenge_lock:
+            if self.challenge is None:
+                header = self.http.get(f"{self.scheme}://{self.registry}/v2/").headers.get("www-authenticate", "")
+                if header.lower().startswith("bearer "):
+                    self.challenge = dict(re.findall(r'(\w+)="([^"]*)"', header))
+                else:
+                    self.challenge = {}
+            return self.challenge
+
+    def bearer_token(self, scopes):
+        """
+        Get a registry v2 bearer token valid for all the given scopes
+        (e.g. "repository:namespace/repo:pull"), or None if the registry does
+        not use token authentication.
+        Tokens are cached per scope until they expire.
+        """
+        scopes = list(scopes)
+        now = time.monotonic()
+        with self.tokens_lock:
+            cached = {self.tokens.get(scope) for scope in scopes}
+            if len(cached) == 1:
+                entry = cached.pop()
+                if entry is not None and entry[1] > now:
+                    return entry[0]
+        challenge = self.auth_challenge()
+        if not challenge:
+            return None
+        resp = self.http.get(
+            challenge["realm"],
+            params={"service": challenge.get("service"), "scope": scopes},
+            auth=(self.username, self.password),
+        )
+        resp.raise_for_status()
+        data = resp.json()
+        token = data.get("token") or data.get("access_token")
+        # Tokens without expires_in are valid 60 seconds (distribution spec)
+        expiry = now + int(data.get("expires_in") or 60) - TOKEN_EXPIRY_MARGIN
+        with self.tokens_lock:
+            for scope in scopes:
+                self.tokens[scope] = (token, expiry)
+        return token
+
+    def remote_labels(self, repo_full, tag):
+        """
+        Return the labels of a remote image using the registry v2 API:
+        the manifest (first entry of a manifest list) then the config blob.
+        Return None if the image does not exist.
+        """
+        session = self.http
+        base_url = f"{self.scheme}://{self.registry}/v2/{repo_full}"
+        headers = {"Accept": MANIFEST_TYPES}
+        token = self.bearer_token([f"repository:{repo_full}:pull"])
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+        resp = session.get(f"{base_url}/manifests/{tag}", headers=headers)
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        manifest = resp.json()
+        if "manifests" in manifest:
+            platforms = [m for m in manifest["manifests"]
+                         if m.get("platform", {}).get("architecture") == "amd64"] or manifest["manifests"]
+            resp = session.get(f"{base_url}/manifests/{platforms[0]['digest']}", headers=headers)
+            resp.raise_for_status()
+            manifest = resp.json()
+        resp = session.get(f"{base_url}/blobs/{manifest['config']['digest']}", headers=headers)
+        resp.raise_for_status()
+        config = json.loads(resp.content.decode("utf-8"))
+        return config.get("config", {}).get("Labels") or {}
+
+    def test_imports(self, image_tag, base_path, worker_path, flavor, build_lines):
+        """
+        Check the imports of the entrypoint of the flavor in the built image:
+        statically when possible, else in a single container run.
+        """
         print("\n🔍 Testing Python imports in built image...")
-        test_code = textwrap.dedent(f'''
-            import os, sys, re, os.path as osp
-
-            entrypoint_full = "{command}"
-            # Use the worker folder as a fallback if the directory from the command isn't found
-            fallback_dir = "{worker_name}"
-            if "/" in entrypoint_full:
-                dir_part = osp.dirname(entrypoint_full)
-                file_part = osp.basename(entrypoint_full)
-                # if the directory part does not exist, try fallback
-                if not os.path.isdir(dir_part) and os.path.isdir(fallback_dir):
-                    dir_part = fallback_dir
-                os.chdir(osp.join(os.getcwd(), dir_part))
-                entrypoint = file_part
+        result = ImportVerifier(self.client).verify(image_tag, base_path, worker_path, flavor, build_lines)
+        if result["status"] == "ok":
+            print(f"✅ Import testing succeeded ({result['method']}, {result['imports']} imports)")
+        else:
+            for module, error in result.get("failed", {}).items():
+                print("❌", module, "- FAILED:", error)
+            warning_message = (f"Import testing {result['status'].upper()} for worker '{basename(worker_path)}'"
+                               f" ({result.get('error') or result['method']})")
+            print("⚠️", warning_message)
+            # GitHub Actions annotation for warning
+            print(f"::warning::{warning_message}")
+        return result
+
+    def generate_dockerfile(self, base, worker_name, flavor, base_reference=None, wheelhouse=False,
+                            optimized=False):
+        """
+        Dockerfile of a worker without its own: a single stage by default.
+        With the wheelhouse and/or optimized, the requirements are installed
+        under /install in a first stage (wheels built with the wheelhouse,
+        bytecode compiled) and only the result goes to the final stage.
+        """
+        # For Alpine, add extra APK commands to install required tools
+        if base.startswith("python:3-alpine") and worker_name in SPECIAL_ALPINE_WORKERS:
+            # Specific alpine setup to support libmagic
+            alpine_setup = "RUN apk add --no-cache file-dev && rm -rf /var/cache/apk/*\n"
+        else:
+            alpine_setup = ""
+
+        def stage(name=None):
+            return [f"FROM {base_reference or base}" + (f" AS {name}" if name else ""),
+                    f"{alpine_setup}WORKDIR /worker", ""]
+
+        # files of the worker in the build context
+        worker_files = f"{CONTEXT_WORKER}/" if wheelhouse else "."
+        requirements_file = f"{CONTEXT_WORKER}/requirements.txt" if wheelhouse else "requirements.txt"
+        requirements = f"{worker_name}/requirements.txt"
+        entrypoint = 'ENTRYPOINT ["python", "{}"]'.format(flavor['command'])
+
+        if not wheelhouse and not optimized:
+            lines = stage() + [
+                f"COPY {requirements_file} {worker_name}/",
+                f"RUN test ! -e {requirements} || pip install --no-cache-dir -r {requirements}",
+                "",
+                f"COPY {worker_files} {worker_name}/",
+                entrypoint,
+            ]
+        else:
+            builder = WHEELS_STAGE if wheelhouse else BUILDER_STAGE
+            if wheelhouse:
+                install = (f"mkdir -p /wheels /install && (test ! -e {requirements} || "
+                           f"(pip wheel --wheel-dir /wheels --find-links /{CONTEXT_WHEELHOUSE} -r {requirements} && "
+                           f"pip install --no-cache-dir --no-index --find-links /wheels --prefix /install "
+                           f"-r {requirements}))")
             else:
-                entrypoint = entrypoint_full
-
-            if not os.path.exists(entrypoint):
-                print("❌ ERROR: {{}} not found inside the container.".format(entrypoint))
-                sys.exit(1)
-
-            with open(entrypoint, 'r', encoding='utf-8') as f:
-                content = f.readlines()
-
-            imports = [line.strip() for line in content if re.match(r'^\\s*(import|from)\\s+[a-zA-Z0-9_.]+', line)]
-            print("🔍 Checking Python imports from", entrypoint)
-            for imp in imports:
-                try:
-                    exec(imp)
-                    print("✅", imp, "- SUCCESS")
-                except Exception as e:
-                    print("❌", imp, "- FAILED:", e)
-                    sys.exit(1)
-            print("✅ All imports tested successfully!")
-        ''')
-        try:
-            result = subprocess.run(
-                ["docker", "run", "--rm", "--entrypoint", "python", image_tag, "-c", test_code],
-                capture_output=True, text=True
-            )
-            print(result.stdout)
-            if result.returncode != 0:
-                warning_message = f"Import testing FAILED for worker '{worker_name}' with exit code {result.returncode}"
-                print("⚠️", warning_message)
-                # GitHub Actions annotation for warning
-                print(f"::warning::{warning_message}")
+                install = (f"mkdir -p /install && (test ! -e {requirements} || "
+                           f"pip install --no-cache-dir --prefix /install -r {requirements})")
+            lines = stage(builder) + [f"COPY {requirements_file} {worker_name}/"]
+            if wheelhouse:
+                # after the requirements: wheels added by other builds don't
+                # invalidate the layers before the install
+                lines.append(f"COPY {CONTEXT_WHEELHOUSE}/ /{CONTEXT_WHEELHOUSE}/")
+            lines += [f"RUN {install} && ({COMPILEALL} /install || true)" if optimized else f"RUN {install}",
+                      ""]
+            if optimized:
+                # everything compiled to bytecode in the first stage: the final
+                # stage only gets the runtime files
+                lines += [f"COPY {worker_files} {worker_name}/", f"RUN {COMPILEALL} {worker_name}/ || true", ""]
+            lines += stage() + [f"COPY --from={builder} /install /usr/local"]
+            if optimized:
+                lines.append(f"COPY --from={builder} /worker/{worker_name}/ {worker_name}/")
             else:
-                print("✅ Import testing succeeded")
-        except Exception as e:
-            print("Error during import testing:", e)
+                lines.append(f"COPY {worker_files} {worker_name}/")
+            lines.append(entrypoint)
+        return "\n".join(lines) + "\n"
+
+    def content_hash(self, tree_id, base_path, worker_path, flavor, wheelhouse=False, optimized=False,
+                     context_files=None, dependency_set=None):
+        """
+        Hash of everything an image is built from: the git tree object id of
+        the worker directory and, for workers without Dockerfile, the
+        Dockerfiles generated for the build modes (hence the base images) in
+        build order, the files sent with a minimal context and the shared
+        dependency set the image is built on.
+        """
+        sha = hashlib.sha256(tree_id.encode("utf-8"))
+        if not isfile(join(base_path, worker_path, "Dockerfile")):
+            for base in BASE_IMAGES:
+                sha.update(self.generate_dockerfile(base, basename(worker_path), flavor, wheelhouse=wheelhouse,
+                                                    optimized=optimized).encode("utf-8"))
+            if context_files is not None:
+                sha.update("\ncontext:{}".format("\n".join(sorted(context_files))).encode("utf-8"))
+            if dependency_set is not None:
+                sha.update("\nshared:{}".format("\n".join(sorted(dependency_set))).encode("utf-8"))
+        return sha.hexdigest()
 
-    def build_docker(self, namespace, base_path, worker_path, flavor, git_commit_sha):
+    def build_docker(self, namespace, base_path, worker_path, flavor, git_commit_sha, content_hash=None,
+                     base_cache=None, base_images=None, shared_layers=None, wheelhouse=None, report=None,
+                     minimal_context=False, optimized=False, measure_startup=False):
         worker_name = basename(worker_path)
+        if report is None:
+            report = RunReport()
+        labels = {
+            "schema-version": "1.0",
+            "org.label-schema.build-date": datetime.datetime.now().isoformat("T") + "Z",
+            "org.label-schema.name": worker_name,
+            "org.label-schema.description": flavor["description"].replace("'", "''")[:100],
+            "org.label-schema.url": "https://thehive-project.org",
+            "org.label-schema.vcs-url": "https://github.com/TheHive-Project/Cortex-Analyzers",
+            VCS_REF_LABEL: git_commit_sha,
+            "org.label-schema.vendor": "TheHive Project",
+            "org.label-schema.version": flavor["version"],
+        }
+        if content_hash is not None:
+            labels[CONTENT_HASH_LABEL] = content_hash
 
-        def build(dockerfile):
+        # output of the builds, for the import test
+        build_lines = []
+
+        def build(dockerfile, pull=True, context=None, target=None):
             try:
+                if context is None:
+                    options = {"path": join(base_path, worker_path), "dockerfile": dockerfile}
+                else:
+                    options = {"fileobj": context, "custom_context": True, "dockerfile": "Dockerfile"}
+                if target is not None:
+                    options["target"] = target
                 (image, output) = self.client.images.build(
-                    path=join(base_path, worker_path),
-                    dockerfile=dockerfile,
-                    pull=True,
-                    labels={
-                        "schema-version": "1.0",
-                        "org.label-schema.build-date": datetime.datetime.now().isoformat("T") + "Z",
-                        "org.label-schema.name": worker_name,
-                        "org.label-schema.description": flavor["description"].replace("'", "''")[:100],
-                        "org.label-schema.url": "https://thehive-project.org",
-                        "org.label-schema.vcs-url": "https://github.com/TheHive-Project/Cortex-Analyzers",
-                        "org.label-schema.vcs-ref": git_commit_sha,
-                        "org.label-schema.vendor": "TheHive Project",
-                        "org.label-schema.version": flavor["version"],
-                    },
-                    tag=f"{namespace}/{flavor['repo']}",
+                    pull=pull,
+                    labels=labels,
+                    tag=f"{namespace}/{flavor['repo']}" if target is None else f"{namespace}/{flavor['repo']}:{target}",
+                    **options,
                 )
+                lines = []
                 for line in output:
                     if "stream" in line:
+                        lines.append(line['stream'])
                         print(f" > {line['stream'].strip()}")
+                if target is None:
+                    self.record_build(report, flavor, image, lines)
+                build_lines.extend(lines)
+                return lines
             except Exception as e:
                 print(f"build failed for worker {worker_name}")
                 traceback.print_exc()
                 raise e
 
+        full_size = context_size(join(base_path, worker_path))
         if isfile(join(base_path, worker_path, "Dockerfile")):
-            build(None)
+            report.update(flavor['name'], context={'size': full_size, 'full_size': full_size})
+            with report.timed(flavor['name'], 'build'):
+                build(None)
+            self.report_sizes(report, flavor)
         else:
-            # Define the base images to try, in order
-            base_images = ["python:3-alpine", "python:3-slim", "python:3"]
+            build_context = None
+            if minimal_context:
+                # only the files the flavor needs, streamed from memory
+                build_context = BuildContext(base_path, worker_path, flavor)
+                print(f"Build context of {flavor['name']}: {len(build_context.files)} files, "
+                      f"{build_context.size} bytes (full context: {full_size} bytes)")
+            report.update(flavor['name'], context={
+                'size': full_size if build_context is None else build_context.size, 'full_size': full_size,
+                'files': None if build_context is None else len(build_context.files)})
             last_exception = None
-            
-            # List of workers that need a special Alpine setup to support libmagic
-            # --> not developped correctly to support single Dockerfile in repository (multiple .py entrypoint file)
-            special_alpine_workers = ["PaloAltoNGFW"]
-
-            for base in base_images:
-                # For Alpine, add extra APK commands to install required tools
-                if base.startswith("python:3-alpine"):
-                    if worker_name in special_alpine_workers:
-                        # Specific alpine setup to support libmagic
-                        alpine_setup = "RUN apk add --no-cache file-dev && rm -rf /var/cache/apk/*\n"
-                    else:
-                        # Regular Alpine setup (if needed)
-                        alpine_setup = ""
-                else:
-                    alpine_setup = ""
-                
-                dockerfile_content = f"""  
-                FROM {base}
-                {alpine_setup}WORKDIR /worker
-
-                COPY requirements.txt {worker_name}/
-                RUN test ! -e {worker_name}/requirements.txt || pip install --no-cache-dir -r {worker_name}/requirements.txt
-
-                COPY . {worker_name}/
-                ENTRYPOINT ["python", "{flavor['command']}"]
-                """
+            candidates = BASE_IMAGES
+            if base_cache is not None:
+                requirements = requirements_hash(join(base_path, worker_path))
+                candidates = base_cache.order(worker_name, requirements, BASE_IMAGES)
+
+            for base in candidates:
+                with report.timed(flavor['name'], 'base_image'):
+                    # Base images pulled once per run are pinned, and not pulled again
+                    base_reference = base_images.resolve(base) if base_images is not None else None
+                    if shared_layers is not None:
+                        # Shared image with the dependencies common to several workers
+                        base_reference = shared_layers.image_for(
+                            base, base_reference, join(base_path, worker_path)) or base_reference
+                dockerfile_content = self.generate_dockerfile(base, worker_name, flavor, base_reference,
+                                                              wheelhouse is not None, optimized)
                 print(f"Trying build for worker {worker_name} using base image {base}...")
                 with tempfile.NamedTemporaryFile() as f:
                     f.write(dockerfile_content.encode("utf-8"))
                     f.flush()
                     try:
-                        build(f.name)
+                        with report.timed(flavor['name'], 'build'):
+                            if wheelhouse is not None:
+                                self.build_with_wheelhouse(build, wheelhouse, namespace, base_path, worker_path,
+                                                           flavor, base, base_reference, dockerfile_content,
+                                                           build_context)
+                            elif build_context is not None:
+                                with build_context.tar(dockerfile_content) as context:
+                                    build(None, pull=base_reference is None, context=context)
+                            else:
+                                build(f.name, pull=base_reference is None)
+                        if base_cache is not None:
+                            base_cache.record(worker_name, requirements, base, True)
+                        report.update(flavor['name'], base=base, base_attempt=candidates.index(base) + 1)
+                        self.report_sizes(report, flavor)
+                        if wheelhouse is not None:
+                            hits, misses = wheelhouse.stats.get(worker_name, (0, 0))
+                            report.update(flavor['name'], wheelhouse={'hits': hits, 'misses': misses,
+                                                                      'error': wheelhouse.errors.get(worker_name)})
                         image_tag = f"{namespace}/{flavor['repo']}"
                         print(f"Build succeeded for worker {worker_name} using base image {base}.")
                         # Test the imports before pushing.
                         try:
-                            self.test_imports(image_tag, flavor['command'], worker_name)
+                            with report.timed(flavor['name'], 'import_test'):
+                                result = self.test_imports(image_tag, base_path, worker_path, flavor, build_lines)
+                            report.update(flavor['name'], import_test=result)
                         except Exception as e:
                             print("Import testing encountered an error:", e)
+                            report.update(flavor['name'], import_test={'status': 'error', 'error': str(e)})
+                        if measure_startup:
+                            self.measure_startup(report, image_tag, base_path, worker_path, flavor, optimized)
                         return  # Build succeeded; exit the function
                     except BuildError as be:
                         print(f"BuildError encountered with base image {base} for worker {worker_name}.")
+                        if base_cache is not None:
+                            base_cache.record(worker_name, requirements, base, False)
                         last_exception = be
 
             print(f"All build attempts failed for worker {worker_name}.")
             raise last_exception
 
+    def record_build(self, report, flavor, image, lines):
+        """
+        Size and layer count of the built image, and build cache usage (steps
+        of the build output served from the cache).
+        """
+        steps = sum(1 for line in lines if re.match(r'Step \d+/\d+ :', line))
+        cached = sum(1 for line in lines if 'Using cache' in line)
+        report.update(flavor['name'],
+                      image={'id': image.id, 'size': image.attrs.get('Size'),
+                             'layers': len(image.attrs.get('RootFS', {}).get('Layers', []))},
+                      build_cache={'steps': steps, 'cached': cached})
+
+    def measure_startup(self, report, image_tag, base_path, worker_path, flavor, optimized):
+        try:
+            with report.timed(flavor['name'], 'startup_probe'):
+                startup = ImportVerifier(self.client).startup_time(image_tag, base_path, worker_path, flavor)
+            startup['optimized'] = optimized
+            report.update(flavor['name'], startup=startup)
+            if startup['status'] == 'ok':
+                print(f"⏱️ Container start to first import: {startup['first_import']:.3f}s, "
+                      f"to all imports: {startup['imports']:.3f}s ({'optimized' if optimized else 'standard'} image)")
+            else:
+                print(f"Startup measure of {image_tag} failed: {startup['status']}")
+        except Exception as e:
+            print(f"Startup measure of {image_tag} failed: {e}")
 
+    def report_sizes(self, report, flavor):
+        """
+        Print the context and image sizes of the flavor, with the image size
+        of the previous run.
+        """
+        record = report.flavor(flavor['name'])
+        size = record.get('image', {}).get('size')
+        previous = report.previous.get(flavor['name'], {}).get('image', {}).get('size')
+        report.update(flavor['name'], previous_image_size=previous)
+        print(f"Image of {flavor['name']}: {size} bytes (previous run: {previous or 'unknown'}), "
+              f"build context {record['context']['size']} bytes (full: {record['context']['full_size']})")
 
+    def build_with_wheelhouse(self, build, wheelhouse, namespace, base_path, worker_path, flavor, base,
+                              base_reference, dockerfile_content, build_context=None):
+        worker_name = basename(worker_path)
+        with wheelhouse.context(join(base_path, worker_path), base, dockerfile_content, build_context) as context:
+            lines = build(None, pull=base_reference is None, context=context)
+        wheelhouse.record(worker_name, lines)
+        # The wheels stage is in the build cache: tag it to copy the new wheels
+        wheels_image = f"{namespace}/{flavor['repo']}:{WHEELS_STAGE}"
+        try:
+            with wheelhouse.context(join(base_path, worker_path), base, dockerfile_content,
+                                    build_context) as context:
+                build(None, pull=False, context=context, target=WHEELS_STAGE)
+            wheelhouse.collect(self.client, wheels_image, base, join(base_path, worker_path))
+        except Exception as e:
+            print(f"Wheelhouse update failed for worker {worker_name}: {e}")
+            wheelhouse.failed(worker_name, e)
+        finally:
+            try:
+                self.client.images.remove(wheels_image)
+            except Exception:
+                pass
 
-    def push_image(self, namespace, repo, tag):
+    def push_image(self, namespace, repo, tag, source=None, stats=None):
+        """
+        Push the local image and return the manifest digest reported by the
+        push, or None. stats, if given, is filled with the push summary.
+        """
         return None
 
+    def push(self, namespace, repo, tag, source=None, stats=None):
+        self.remote_digests.pop((namespace, repo, tag), None)
+        if self.push_engine is not None:
+            return self.push_engine.push(self, namespace, repo, tag, source)
+        return self.push_image(namespace, repo, tag, source, stats)
+
+    def stream_push(self, repository, tag, stats=None):
+        """
+        Push repository:tag with the Docker daemon, following its progress
+        stream, and return the manifest digest. A push failing on some
+        layers is attempted again: the layers already on the registry are
+        skipped by the daemon, only the failed ones are sent again.
+        """
+        for attempt in range(1, PUSH_ATTEMPTS + 1):
+            stream = PushStream(repository, tag)
+            try:
+                stream.follow(self.client.images.push(
+                    repository, tag=tag, stream=True, decode=True,
+                    auth_config={"username": self.username, "password": self.password}))
+            except (APIError, requests.exceptions.RequestException) as e:
+                stream.error = str(e)
+            if stream.error is None:
+                summary = stream.summary()
+                print(f"Pushed {repository}:{tag} ({self.name()}): {summary['pushed']} layers sent "
+                      f"({summary['bytes']} bytes in {summary['seconds']:.1f}s, {summary['throughput'] or 0} bytes/s), "
+                      f"{summary['existing']} already there, {summary['mounted']} mounted, digest {stream.digest}")
+                if stats is not None:
+                    stats.update(summary, attempts=attempt)
+                return stream.digest
+            failed = stream.failed_layers()
+            print(f"Push of {repository}:{tag} failed ({self.name()}, attempt {attempt}/{PUSH_ATTEMPTS}) "
+                  f"on layers {', '.join(failed) or 'unknown'}: {stream.error}")
+            if attempt < PUSH_ATTEMPTS:
+                time.sleep(PUSH_RETRY_DELAY * attempt)
+        raise Exception(f"push of {repository}:{tag} failed: {stream.error}")
+
+    def retag_image(self, namespace, repo, reference, new_tag):
+        """
+        Tag an already pushed manifest (tag or digest) as new_tag on the
+        registry, through the registry v2 API: no local tag and no push.
+        """
+        repo_full = f"{namespace}/{repo}"
+        url = f"{self.scheme}://{self.registry}/v2/{repo_full}/manifests"
+        headers = {"Accept": MANIFEST_TYPES}
+        token = self.bearer_token([f"repository:{repo_full}:pull,push"])
+        if token is not None:
+            headers["Authorization"] = f"Bearer {token}"
+        resp = self.http.get(f"{url}/{reference}", headers=headers)
+        resp.raise_for_status()
+        headers["Content-Type"] = resp.headers["Content-Type"]
+        self.http.put(f"{url}/{new_tag}", data=resp.content, headers=headers).raise_for_status()
+
     def get_remote_image_id(self, namespace, repo, tag):
         return None
 
-    def correctly_pushed(self, namespace, repo, tag):
-        image_tag = "{}/{}:{}".format(namespace, repo, tag)
-        if not self.default_registry:
-            image_tag = "{}/{}".format(self.registry, image_tag)
-        local_id = self.client.images.get_registry_data(
-            image_tag,
-            auth_config={"username": self.username, "password": self.password},
-        ).id
-        remote_id = self.get_remote_image_id(namespace, repo, tag)
-        if remote_id is None:
-            return True
+    def remote_digest(self, namespace, repo, tag):
+        """
+        Digest of the manifest of namespace/repo:tag on the registry (registry
+        v2 API, HEAD of the manifest), None if the tag does not exist.
+        Looked up once, until the next push of the tag.
+        """
+        key = (namespace, repo, tag)
+        if key not in self.remote_digests:
+            repo_full = f"{namespace}/{repo}"
+            headers = {"Accept": MANIFEST_TYPES}
+            token = self.bearer_token([f"repository:{repo_full}:pull"])
+            if token is not None:
+                headers["Authorization"] = f"Bearer {token}"
+            resp = self.http.head(f"{self.scheme}://{self.registry}/v2/{repo_full}/manifests/{tag}", headers=headers)
+            if resp.status_code == 404:
+                self.remote_digests[key] = None
+            else:
+                resp.raise_for_status()
+                self.remote_digests[key] = resp.headers.get("Docker-Content-Digest")
+        return self.remote_digests[key]
+
+    def correctly_pushed(self, namespace, repo, tag, digest=None):
+        """
+        Compare the digest reported by the push with the one of the tag on
+        the registry. Without digest, the tag only has to exist.
+        """
         try:
-            print(f"DEBUG: Comparing local_id and remote_id, local_id: {local_id}, remote_id: {remote_id}")
-        except NameError as e:
-            print(f"Error: {e}. Ensure 'local_id' and 'remote_id' are defined before comparing.")
-        return local_id == remote_id
\ No newline at end of file
+            remote_id = self.remote_digest(namespace, repo, tag)
+        except Exception as e:
+            print(f"Manifest lookup of {namespace}/{repo}:{tag} failed ({e}), using the registry API")
+            remote_id = self.get_remote_image_id(namespace, repo, tag)
+            if remote_id is None:
+                return True
+        if digest is None:
+            return remote_id is not None
+        print(f"Pushed digest {digest}, registry digest {remote_id}")
+        return digest == remote_id
\ No newline at end of file
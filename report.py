@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+import datetime
+import json
+import threading
+import time
+from contextlib import contextmanager
+from os.path import isfile
+
+from jsonfile import atomic_write
+
+
+class RunReport:
+    """
+    Machine-readable report of a run, written as JSON lines: one line per
+    flavor with the time spent in each phase (remote lookup, change
+    detection, build, import test, and push, tag and verification for each
+    registry), the image size, its layer count and the build cache usage,
+    then one line for the whole run.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.flavors = {}
+        # flavors of the report of the previous run, to compare with
+        self.previous = {}
+        self.previous_run = {}
+        if path is not None and isfile(path):
+            try:
+                with open(path) as report_file:
+                    records = [json.loads(line) for line in report_file if line.strip()]
+                self.previous = {record['name']: record for record in records if record.get('type') == 'flavor'}
+                self.previous_run = next((record for record in records if record.get('type') == 'run'), {})
+            except Exception as e:
+                print("Previous run report {} ignored: {}".format(path, e))
+        self.run = {'type': 'run', 'start': datetime.datetime.now().isoformat('T') + 'Z', 'phases': {}}
+        self.start = time.monotonic()
+
+    def flavor(self, name):
+        with self.lock:
+            return self.flavors.setdefault(name, {'type': 'flavor', 'name': name, 'phases': {}, 'registries': {}})
+
+    def update(self, name, registry=None, **fields):
+        record = self.flavor(name)
+        with self.lock:
+            if registry is not None:
+                record['registries'].setdefault(registry, {}).update(fields)
+            else:
+                record.update(fields)
+
+    def add_time(self, name, phase, seconds, registry=None):
+        record = self.flavor(name) if name is not None else self.run
+        with self.lock:
+            if registry is not None:
+                phases = record['registries'].setdefault(registry, {})
+            else:
+                phases = record['phases']
+            phases[phase] = round(phases.get(phase, 0) + seconds, 3)
+
+    @contextmanager
+    def timed(self, name, phase, registry=None):
+        """
+        Time a phase of a flavor (or of the run when name is None).
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, phase, time.monotonic() - start, registry)
+
+    def records(self):
+        with self.lock:
+            run = dict(self.run, duration=round(time.monotonic() - self.start, 3))
+            return [self.flavors[name] for name in sorted(self.flavors)] + [run]
+
+    def write(self):
+        if self.path is None:
+            return
+        with atomic_write(self.path) as report_file:
+            for record in self.records():
+                report_file.write(json.dumps(record, sort_keys=True) + '\n')
+        print('Run report written to {}'.format(self.path))
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import sys
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from os import makedirs
+from os.path import join
+
+
+class WorkerLog:
+    """
+    Line buffered output of one worker: every complete line is prefixed with
+    the worker name on the console and written to the worker log file, which
+    only holds the output of the current run.
+    """
+
+    def __init__(self, name, console, console_lock, log_dir=None):
+        self.name = name
+        self.console = console
+        self.console_lock = console_lock
+        # Build and push tasks of a worker may run at the same time: keep
+        # one pending partial line per thread so lines never get mixed.
+        self.pending = threading.local()
+        self.lock = threading.Lock()
+        self.file = None
+        if log_dir is not None:
+            makedirs(log_dir, exist_ok=True)
+            # line buffered: the log file follows the build as it runs. The
+            # log of the previous run is replaced, logs don't grow run after run
+            self.file = open(join(log_dir, '{}.log'.format(name)), 'w', buffering=1, encoding='utf-8')
+
+    def write(self, data):
+        buffer = getattr(self.pending, 'buffer', '') + data
+        while '\n' in buffer:
+            line, buffer = buffer.split('\n', 1)
+            self.write_line(line)
+        self.pending.buffer = buffer
+        return len(data)
+
+    def write_line(self, line):
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + '\n')
+        with self.console_lock:
+            self.console.write('[{}] {}\n'.format(self.name, line))
+
+    def flush(self):
+        buffer = getattr(self.pending, 'buffer', '')
+        if buffer:
+            self.write_line(buffer)
+            self.pending.buffer = ''
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class WorkerOutput:
+    """
+    File-like object installed as sys.stdout/sys.stderr while the scheduler
+    runs: writes are routed to the WorkerLog of the current thread, or to the
+    original stream when the thread is not running a worker task.
+    """
+
+    def __init__(self, stream, local, console_lock):
+        self.stream = stream
+        self.local = local
+        self.console_lock = console_lock
+
+    def write(self, data):
+        log = getattr(self.local, 'log', None)
+        if log is None:
+            with self.console_lock:
+                return self.stream.write(data)
+        return log.write(data)
+
+    def flush(self):
+        log = getattr(self.local, 'log', None)
+        if log is not None:
+            log.flush()
+        self.stream.flush()
+
+    def isatty(self):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class Scheduler:
+    """
+    Run worker builds in a bounded build pool and image pushes in a separate
+    bounded push pool. Output of every task is prefixed with its name (worker
+    or flavor, see capture) and, when log_dir is set, written to
+    <log_dir>/<name>.log. Exceptions raised by the tasks are kept in
+    errors, as (name, exception) pairs, once joined.
+    """
+
+    def __init__(self, build_jobs=1, push_jobs=1, log_dir=None):
+        self.build_pool = ThreadPoolExecutor(max_workers=max(1, build_jobs), thread_name_prefix='build')
+        self.push_pool = ThreadPoolExecutor(max_workers=max(1, push_jobs), thread_name_prefix='push')
+        self.log_dir = log_dir
+        self.local = threading.local()
+        self.console_lock = threading.Lock()
+        self.lock = threading.Lock()
+        self.futures = []
+        self.names = {}
+        self.errors = []
+        self.logs = {}
+        self.console = sys.stdout
+
+    def worker_log(self, name):
+        with self.lock:
+            if name not in self.logs:
+                self.logs[name] = WorkerLog(name, self.console, self.console_lock, self.log_dir)
+            return self.logs[name]
+
+    @contextmanager
+    def capture(self, name):
+        previous = getattr(self.local, 'log', None)
+        self.local.log = self.worker_log(name)
+        try:
+            yield
+        finally:
+            self.local.log.flush()
+            self.local.log = previous
+
+    def _submit(self, pool, name, fn, *args):
+        def task():
+            with self.capture(name):
+                try:
+                    return fn(*args)
+                except Exception:
+                    traceback.print_exc()
+                    raise
+
+        future = pool.submit(task)
+        with self.lock:
+            self.futures.append(future)
+            self.names[future] = name
+        return future
+
+    def submit_build(self, name, fn, *args):
+        return self._submit(self.build_pool, name, fn, *args)
+
+    def submit_push(self, name, fn, *args):
+        return self._submit(self.push_pool, name, fn, *args)
+
+    def join(self):
+        # Tasks may submit other tasks (a build submits its pushes), so wait
+        # until no pending future is left.
+        while True:
+            with self.lock:
+                pending = [f for f in self.futures if not f.done()]
+            if not pending:
+                break
+            wait(pending, return_when=FIRST_COMPLETED)
+        self.errors = [(self.names[f], f.exception()) for f in self.futures if f.exception() is not None]
+        return self.errors
+
+    @contextmanager
+    def running(self):
+        stdout, stderr = sys.stdout, sys.stderr
+        self.console = stdout
+        sys.stdout = WorkerOutput(stdout, self.local, self.console_lock)
+        sys.stderr = WorkerOutput(stderr, self.local, self.console_lock)
+        try:
+            yield self
+            self.join()
+        finally:
+            self.build_pool.shutdown(wait=True)
+            self.push_pool.shutdown(wait=True)
+            sys.stdout, sys.stderr = stdout, stderr
+            for log in self.logs.values():
+                log.close()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import statistics
+from collections import Counter
+from os.path import basename
+
+from jsonfile import load_json, save_json
+
+# Estimated duration (seconds) of a worker never built, when no history at all
+DEFAULT_DURATION = 60.0
+
+
+class ShardError(Exception):
+    pass
+
+
+def parse_shard(value):
+    """
+    "i/N" -> (i, N), shards numbered from 1.
+    """
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be i/N, e.g. 1/4: {}".format(value))
+    if count < 1 or not 1 <= index <= count:
+        raise argparse.ArgumentTypeError("shard index must be between 1 and N: {}".format(value))
+    return index, count
+
+
+def measure(records):
+    """
+    Duration of each worker built by a run (all its flavors: build, import
+    test, pushes...), from the records of its RunReport.
+    """
+    measured = {}
+    for record in records:
+        if record.get('type') != 'flavor' or record.get('status') != 'built':
+            continue
+        seconds = sum(record['phases'].values())
+        seconds += sum(value for registry in record['registries'].values()
+                       for value in registry.values() if isinstance(value, float))
+        measured[record['worker']] = measured.get(record['worker'], 0) + seconds
+    return {worker: round(seconds, 3) for worker, seconds in measured.items()}
+
+
+class DurationHistory:
+    """
+    Duration of the last build of each worker, persisted between runs:
+
+    {"<worker>": <seconds>}
+
+    The shards of a run must compute the same partition, so they all read
+    the same history and do not update it: their durations are written in
+    their summaries and recorded by merge_summaries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.durations = load_json(path, "Duration history", {})
+
+    def update(self, durations):
+        """
+        Record the durations of the workers built by a run (see measure).
+        Workers only skipped keep their duration.
+        """
+        self.durations.update(durations)
+
+    def estimate(self, worker):
+        if worker in self.durations:
+            return self.durations[worker]
+        if self.durations:
+            return statistics.median(self.durations.values())
+        return DEFAULT_DURATION
+
+    def save(self):
+        if self.path is None:
+            return
+        save_json(self.path, self.durations, indent=2, sort_keys=True)
+
+
+def partition(workers, history, count):
+    """
+    Split the workers in count shards of balanced estimated duration
+    (longest processing time first: each worker, longest first, goes to the
+    least loaded shard). A worker, and so each of its flavors, is in exactly
+    one shard. The result only depends on the worker list and the history,
+    so every runner computes the same partition.
+    """
+    shards = [[] for _ in range(count)]
+    loads = [0.0] * count
+    for worker in sorted(workers, key=lambda w: (-history.estimate(basename(w)), w)):
+        shard = min(range(count), key=lambda i: (loads[i], i))
+        shards[shard].append(worker)
+        loads[shard] += history.estimate(basename(worker))
+    return [sorted(shard) for shard in shards], loads
+
+
+def shard_workers(workers, history, index, count):
+    """
+    Workers of shard index/count, and the partition written in the summary
+    of the shard: its id (hash of all the shards), the workers of the shard
+    and all the workers partitioned.
+    """
+    shards, loads = partition(workers, history, count)
+    plan = hashlib.sha256(json.dumps(shards).encode('utf-8')).hexdigest()[:12]
+    # runners with different histories compute different partitions: the
+    # plan ids are compared when merging the summaries
+    print('Shard {}/{}: {} of {} workers, estimated {:.0f}s (longest shard {:.0f}s, plan {})'.format(
+        index, count, len(shards[index - 1]), len(workers), loads[index - 1], max(loads), plan))
+    return shards[index - 1], {'id': plan, 'workers': shards[index - 1], 'all_workers': sorted(workers)}
+
+
+def write_summary(path, shard, list_summary, partition=None, durations=None):
+    """
+    Write the SKIPPED/SUCCEED/FAILED lists of a run (or of one shard, with
+    its partition and the durations of the workers it built).
+    """
+    save_json(path, {
+        'shard': None if shard is None else '{}/{}'.format(*shard),
+        'plan': None if partition is None else partition['id'],
+        'workers': None if partition is None else partition['workers'],
+        'all_workers': None if partition is None else partition['all_workers'],
+        'skipped': sorted(list_summary[0]),
+        'succeeded': sorted(list_summary[1]),
+        'failed': sorted(list_summary[2]),
+        'durations': durations or {},
+    }, indent=2)
+    print('Summary written to {}'.format(path))
+
+
+def merge_summaries(paths, history=None):
+    """
+    Merge the summaries written by the shards of a run into one list_summary,
+    and record the durations measured by the shards in history. Raise
+    ShardError if the shards did not compute the same partition, if a shard
+    is missing or if a worker of the partition was built by no shard or by
+    several ones.
+    """
+    list_summary = [[], [], []]
+    summaries = []
+    for path in paths:
+        with open(path) as summary_file:
+            summary = json.load(summary_file)
+        summaries.append(summary)
+        list_summary[0] += summary['skipped']
+        list_summary[1] += summary['succeeded']
+        list_summary[2] += summary['failed']
+
+    plans = {summary.get('plan') for summary in summaries}
+    if len(plans) > 1:
+        raise ShardError('summaries of different shard partitions (plans {}): the shards did not share the same '
+                         'duration history'.format(', '.join(sorted(str(plan) for plan in plans))))
+    shards = Counter(summary.get('shard') for summary in summaries if summary.get('shard') is not None)
+    twice = sorted(shard for shard, count in shards.items() if count > 1)
+    if twice:
+        raise ShardError('several summaries of shard {}'.format(', '.join(twice)))
+    counts = {shard.split('/')[1] for shard in shards}
+    if len(counts) > 1:
+        raise ShardError('summaries of runs split in {} shards'.format(' and '.join(sorted(counts))))
+    if counts:
+        missing = sorted(set(range(1, int(counts.pop()) + 1)) - {int(shard.split('/')[0]) for shard in shards})
+        if missing:
+            raise ShardError('summary of shard {} missing'.format(', '.join(str(index) for index in missing)))
+    if plans != {None}:
+        built = Counter(worker for summary in summaries for worker in summary['workers'])
+        twice = sorted(worker for worker, count in built.items() if count > 1)
+        if twice:
+            raise ShardError('workers built by several shards: {}'.format(', '.join(twice)))
+        missing = sorted(set(summaries[0]['all_workers']) - set(built))
+        if missing:
+            raise ShardError('workers built by no shard: {}'.format(', '.join(missing)))
+    if history is not None:
+        for summary in summaries:
+            history.update(summary.get('durations') or {})
+    return list_summary
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import datetime
+import hashlib
+import io
+import shlex
+import threading
+from collections import Counter
+from os.path import isfile, join, basename
+
+# Repository of the shared dependency images, tagged <base tag>-<hash>
+SHARED_REPO = "cortex-neurons-base"
+# Maximum number of dependency sets turned into shared images
+MAX_SHARED_SETS = 8
+
+
+def parse_requirements(worker_dir):
+    """
+    Requirement lines of the requirements.txt of a worker, normalized.
+    Options (-r, --index-url...) and comments are ignored.
+    """
+    path = join(worker_dir, 'requirements.txt')
+    requirements = set()
+    if isfile(path):
+        with open(path) as requirements_file:
+            for line in requirements_file:
+                line = line.split(' #', 1)[0].strip()
+                if line and not line.startswith(('#', '-')):
+                    requirements.add(line.replace(' ', '').lower())
+    return requirements
+
+
+class SharedLayers:
+    """
+    Dependency sets common to several workers, installed once in shared
+    intermediate images (FROM <base> + pip install <set>) that the generated
+    Dockerfiles of these workers use as base image: the dependency layers are
+    built once and shared by every image in the registry and on Cortex nodes.
+
+    Shared images are built on first use for each base image, pulled from the
+    first registry when they were already published by a previous run.
+    """
+
+    def __init__(self, client, namespace, dependency_sets, registries):
+        self.client = client
+        self.namespace = namespace
+        self.dependency_sets = dependency_sets
+        self.registries = registries
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.images = {}
+        self.built = []
+
+    @classmethod
+    def plan(cls, client, namespace, base_path, workers, min_workers, registries):
+        requirements = {}
+        for worker_path in workers:
+            worker_dir = join(base_path, worker_path)
+            if not isfile(join(worker_dir, 'Dockerfile')):
+                requirements[basename(worker_path)] = parse_requirements(worker_dir)
+
+        # requirements used by at least min_workers workers, then the subsets
+        # of these requirements actually declared together by the workers
+        counts = Counter(r for reqs in requirements.values() for r in reqs)
+        frequent = {r for r, count in counts.items() if count >= min_workers}
+        candidates = {frozenset(reqs & frequent) for reqs in requirements.values() if reqs & frequent}
+        coverage = {candidate: sum(1 for reqs in requirements.values() if candidate <= reqs)
+                    for candidate in candidates}
+        dependency_sets = sorted((c for c in candidates if coverage[c] >= min_workers),
+                                 key=lambda c: (coverage[c] * len(c), sorted(c)), reverse=True)[:MAX_SHARED_SETS]
+
+        print('Shared layers: {} dependency sets for {} workers'.format(len(dependency_sets), len(requirements)))
+        for dependency_set in dependency_sets:
+            print('  {} workers: {}'.format(coverage[dependency_set], ' '.join(sorted(dependency_set))))
+        return cls(client, namespace, dependency_sets, registries)
+
+    def dependency_set(self, worker_dir):
+        """
+        Largest shared dependency set declared by the worker, or None.
+        """
+        requirements = parse_requirements(worker_dir)
+        sets = [s for s in self.dependency_sets if s <= requirements]
+        return max(sets, key=lambda s: (len(s), sorted(s))) if sets else None
+
+    def tag(self, base, base_reference, dependency_set):
+        sha = hashlib.sha256(base_reference.encode('utf-8'))
+        for requirement in sorted(dependency_set):
+            sha.update(requirement.encode('utf-8'))
+        return '{}-{}'.format(base.rsplit(':', 1)[-1], sha.hexdigest()[:12])
+
+    def image_for(self, base, base_reference, worker_dir):
+        """
+        Local shared image to use instead of base for this worker, or None.
+        """
+        dependency_set = self.dependency_set(worker_dir)
+        if dependency_set is None:
+            return None
+        tag = self.tag(base, base_reference or base, dependency_set)
+        with self.lock:
+            image_lock = self.locks.setdefault(tag, threading.Lock())
+        with image_lock:
+            if tag not in self.images:
+                self.images[tag] = self.pull(tag) or self.build(tag, base_reference or base, dependency_set)
+            return self.images[tag]
+
+    def remote_name(self, registry):
+        if registry.default_registry:
+            return '{}/{}'.format(self.namespace, SHARED_REPO)
+        return '{}/{}/{}'.format(registry.registry, self.namespace, SHARED_REPO)
+
+    def pull(self, tag):
+        if not self.registries:
+            return None
+        registry = self.registries[0]
+        try:
+            image = self.client.images.pull(
+                self.remote_name(registry), tag=tag,
+                auth_config={'username': registry.username, 'password': registry.password})
+            local = '{}/{}:{}'.format(self.namespace, SHARED_REPO, tag)
+            image.tag('{}/{}'.format(self.namespace, SHARED_REPO), tag=tag)
+            print('Shared image {} pulled from {}'.format(local, registry.name()))
+            return local
+        except Exception:
+            return None
+
+    def build(self, tag, base_reference, dependency_set):
+        local = '{}/{}:{}'.format(self.namespace, SHARED_REPO, tag)
+        dockerfile = 'FROM {}\nRUN pip install --no-cache-dir {}\n'.format(
+            base_reference, ' '.join(shlex.quote(r) for r in sorted(dependency_set)))
+        print('Building shared image {} ({})'.format(local, ' '.join(sorted(dependency_set))))
+        try:
+            (image, output) = self.client.images.build(
+                fileobj=io.BytesIO(dockerfile.encode('utf-8')),
+                pull=False,
+                labels={
+                    "schema-version": "1.0",
+                    "org.label-schema.build-date": datetime.datetime.now().isoformat("T") + "Z",
+                    "org.label-schema.name": SHARED_REPO,
+                    "org.label-schema.vendor": "TheHive Project",
+                },
+                tag=local,
+            )
+            for line in output:
+                if 'stream' in line:
+                    print(' > {}'.format(line['stream'].strip()))
+        except Exception as e:
+            # workers are then built from the base image, as without shared layers
+            print('Shared image {} build failed: {}'.format(local, e))
+            return None
+        self.built.append(tag)
+        return local
+
+    def push(self):
+        for tag in self.built:
+            for registry in self.registries:
+                try:
+                    registry.push(self.namespace, SHARED_REPO, tag,
+                                  source='{}/{}:{}'.format(self.namespace, SHARED_REPO, tag))
+                except Exception as e:
+                    print('Push of shared image {}:{} failed ({}): {}'.format(SHARED_REPO, tag, registry.name(), e))
+
+    def report(self):
+        print('Shared layers: {} images used, {} built'.format(
+            len([image for image in self.images.values() if image is not None]), len(self.built)))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+import json
+import sys
+from os.path import abspath, dirname, join
+
+import pytest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from shards import DurationHistory, ShardError, merge_summaries, partition, shard_workers, write_summary  # noqa: E402
+
+WORKERS = ['analyzers/{}'.format(name) for name in ('Abuse', 'Crt', 'Dns', 'Geo', 'Maxmind', 'Shodan', 'Urlscan')]
+DURATIONS = {'Abuse': 300.0, 'Crt': 20.0, 'Dns': 45.0, 'Geo': 120.0, 'Maxmind': 90.0, 'Shodan': 60.0}
+
+
+def history(tmp_path, durations=DURATIONS):
+    path = join(str(tmp_path), 'durations.json')
+    with open(path, 'w') as history_file:
+        json.dump(durations, history_file)
+    return DurationHistory(path)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7, 9])
+def test_partition_assigns_each_worker_once(tmp_path, count):
+    shards, loads = partition(WORKERS, history(tmp_path), count)
+    assert len(shards) == count
+    assert sorted(worker for shard in shards for worker in shard) == sorted(WORKERS)
+    assert len(loads) == count
+
+
+def test_partition_balances_estimated_durations(tmp_path):
+    shards, loads = partition(WORKERS, history(tmp_path), 2)
+    # longest first to the least loaded shard, Urlscan estimated at the median (75s)
+    assert shards == [['analyzers/Abuse', 'analyzers/Crt', 'analyzers/Dns'],
+                      ['analyzers/Geo', 'analyzers/Maxmind', 'analyzers/Shodan', 'analyzers/Urlscan']]
+    assert loads == [365.0, 345.0]
+
+
+def test_partition_depends_only_on_workers_and_history(tmp_path):
+    first = partition(WORKERS, history(tmp_path), 3)
+    assert partition(list(reversed(WORKERS)), history(tmp_path), 3) == first
+
+
+def test_partition_without_history(tmp_path):
+    shards, loads = partition(WORKERS, DurationHistory(join(str(tmp_path), 'missing.json')), 3)
+    assert [len(shard) for shard in shards] == [3, 2, 2]
+
+
+def run_shards(directory, durations, count):
+    """
+    Summary paths of the shards of a run, each computing its partition from
+    the given history, the workers built taking 10s.
+    """
+    directory.mkdir(exist_ok=True)
+    paths = []
+    for index in range(1, count + 1):
+        workers, shard_partition = shard_workers(WORKERS, history(directory, durations), index, count)
+        path = join(str(directory), 'summary-{}-of-{}.json'.format(index, count))
+        names = [worker.split('/')[-1] for worker in workers]
+        write_summary(path, (index, count), [[], names, []], shard_partition, {name: 10.0 for name in names})
+        paths.append(path)
+    return paths
+
+
+def test_merge_summaries_records_durations(tmp_path):
+    paths = run_shards(tmp_path / 'run', DURATIONS, 3)
+    merged = history(tmp_path, {'Abuse': 1.0, 'Removed': 5.0})
+    list_summary = merge_summaries(paths, merged)
+    assert sorted(list_summary[1]) == sorted(worker.split('/')[-1] for worker in WORKERS)
+    assert merged.durations == dict({name: 10.0 for name in DURATIONS}, Urlscan=10.0, Removed=5.0)
+
+
+def test_merge_summaries_without_shards(tmp_path):
+    path = join(str(tmp_path), 'summary.json')
+    write_summary(path, None, [['Crt'], ['Dns'], ['Geo -> BuildError']])
+    assert merge_summaries([path]) == [['Crt'], ['Dns'], ['Geo -> BuildError']]
+
+
+def test_merge_summaries_different_plans(tmp_path):
+    first = run_shards(tmp_path / 'first', DURATIONS, 2)[0]
+    second = run_shards(tmp_path / 'second', {}, 2)[1]
+    with pytest.raises(ShardError, match='different shard partitions'):
+        merge_summaries([first, second])
+
+
+def test_merge_summaries_missing_shard(tmp_path):
+    paths = run_shards(tmp_path / 'run', DURATIONS, 3)
+    with pytest.raises(ShardError, match='summary of shard 2 missing'):
+        merge_summaries([paths[0], paths[2]])
+
+
+def test_merge_summaries_duplicated_shard(tmp_path):
+    paths = run_shards(tmp_path / 'run', DURATIONS, 2)
+    with pytest.raises(ShardError, match='several summaries of shard 1/2'):
+        merge_summaries([paths[0], paths[0], paths[1]])
+
+
+def test_merge_summaries_different_counts(tmp_path):
+    paths = []
+    for index, count in ((1, 2), (2, 3), (3, 3)):
+        paths.append(join(str(tmp_path), 'summary-{}-of-{}.json'.format(index, count)))
+        write_summary(paths[-1], (index, count), [[], [], []])
+    with pytest.raises(ShardError, match='split in 2 and 3 shards'):
+        merge_summaries(paths)
+
+
+def test_merge_summaries_does_not_update_history_on_error(tmp_path):
+    paths = run_shards(tmp_path / 'run', DURATIONS, 3)
+    merged = history(tmp_path)
+    with pytest.raises(ShardError):
+        merge_summaries(paths[:2], merged)
+    assert merged.durations == DURATIONS
+
+
+def test_merge_summaries_worker_in_two_shards(tmp_path):
+    paths = run_shards(tmp_path / 'run', DURATIONS, 2)
+    with open(paths[1]) as summary_file:
+        summary = json.load(summary_file)
+    summary['workers'].append('analyzers/Abuse')
+    with open(paths[1], 'w') as summary_file:
+        json.dump(summary, summary_file)
+    with pytest.raises(ShardError, match='workers built by several shards: analyzers/Abuse'):
+        merge_summaries(paths)
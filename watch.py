@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import time
+from os.path import exists
+
+import git
+
+# Seconds between two checks of HEAD
+WATCH_INTERVAL = 10
+# The base image pins and the remote state kept by --watch are dropped after
+# this many seconds, to pick up updated base images and images pushed by others
+REFRESH_INTERVAL = 6 * 3600
+# Seconds given to a client to send its notification
+NOTIFICATION_TIMEOUT = 5
+
+
+class CommitWatcher:
+    """
+    Commits to build in watch mode: HEAD of the repository, polled every
+    interval seconds, and the commits sent on a local socket (one commit
+    sha or ref per connection, e.g. `echo <sha> | nc -U <socket>`), fetched
+    and checked out before the build. Notifications received during a build
+    are merged: only the last one is built.
+    """
+
+    def __init__(self, base_path, interval=WATCH_INTERVAL, socket_path=None):
+        self.repo = git.Repo(base_path)
+        self.interval = interval
+        self.socket_path = socket_path
+        self.server = None
+        if socket_path is not None:
+            if exists(socket_path):
+                os.unlink(socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(socket_path)
+            self.server.listen(16)
+            print('Waiting for commit notifications on {}'.format(socket_path))
+
+    def head(self):
+        return self.repo.head.commit.hexsha
+
+    def notifications(self, timeout):
+        """
+        References received on the socket within timeout seconds (and the
+        ones already pending), oldest first.
+        """
+        references = []
+        self.server.settimeout(timeout)
+        while True:
+            try:
+                connection, _ = self.server.accept()
+            except (socket.timeout, BlockingIOError):
+                return references
+            with connection:
+                connection.settimeout(NOTIFICATION_TIMEOUT)
+                try:
+                    reference = connection.makefile().readline().strip()
+                    if reference:
+                        references.append(reference)
+                        connection.sendall('queued {}\n'.format(reference).encode('utf-8'))
+                except OSError as e:
+                    print('Commit notification failed: {}'.format(e))
+            # pending connections only
+            self.server.settimeout(0)
+
+    def checkout(self, reference):
+        commit = None
+        if self.repo.remotes:
+            try:
+                self.repo.git.fetch('--quiet', self.repo.remotes[0].name, reference)
+                commit = self.repo.commit('FETCH_HEAD').hexsha
+            except git.GitCommandError as e:
+                print('Fetch of {} failed, looking for it locally: {}'.format(reference, e))
+        if commit is None:
+            commit = self.repo.commit(reference).hexsha
+        if commit != self.head():
+            self.repo.git.checkout('--detach', '--quiet', commit)
+
+    def wait(self, last_commit):
+        """
+        Wait for a commit other than last_commit and return it, checked out.
+        """
+        while True:
+            if self.server is not None:
+                references = self.notifications(0 if last_commit is None else self.interval)
+                if references:
+                    try:
+                        self.checkout(references[-1])
+                    except Exception as e:
+                        print('Commit notification {} ignored: {}'.format(references[-1], e))
+            commit = self.head()
+            if commit != last_commit:
+                return commit
+            if self.server is None:
+                time.sleep(self.interval)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            if exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import io
+import re
+import tarfile
+import tempfile
+import threading
+import time
+from os import makedirs, remove, replace, scandir, utime
+from os.path import basename, isdir, isfile, join
+
+from basecache import requirements_hash
+from jsonfile import load_json, save_json
+from sharedlayers import parse_requirements
+
+# Stage of the generated Dockerfile where the wheels are built
+WHEELS_STAGE = "wheels"
+# Directories of the build context in wheelhouse mode
+CONTEXT_WORKER = "worker"
+CONTEXT_WHEELHOUSE = "wheelhouse"
+# Size of the wheelhouse of a base image, in MB, before the least recently
+# used wheels are removed
+WHEELHOUSE_SIZE = 2048
+# Versions of a project kept in the wheelhouse of a base image
+WHEEL_VERSIONS = 2
+# Seconds during which a wheel sent to a build context is not pruned
+PRUNE_GRACE = 60
+
+
+def slug(base):
+    return re.sub(r'[^a-zA-Z0-9.-]', '_', base)
+
+
+def project(name):
+    """
+    Normalized project name of a requirement line or of a wheel file name.
+    """
+    match = re.match(r'[A-Za-z0-9._-]+', name)
+    return re.sub(r'[-_.]+', '_', match.group(0) if match else name).lower()
+
+
+def wheel_project(wheel):
+    return project(wheel.split('-', 1)[0])
+
+
+class Wheelhouse:
+    """
+    Local wheelhouse shared by all builds and kept between runs, with one
+    directory per base image (wheels built on alpine don't run on debian).
+
+    In wheelhouse mode the generated Dockerfile builds the wheels of the
+    requirements in a first stage, finding the wheels already built in the
+    wheelhouse (sent in the build context), and only copies the installed
+    packages into the final stage: the image stays free of the cache.
+    Wheels compiled during a build are then copied back to the wheelhouse.
+    Pure python wheels are not kept: downloading them is cheap.
+
+    A build only gets the wheels of its requirements: the compiled wheels
+    its last build on the base used (index.json, by requirements.txt hash),
+    or before a first build the wheels of the projects it requires. The
+    wheelhouse layer of a worker thus only changes with its requirements.
+    Each base keeps WHEEL_VERSIONS versions of a project and at most
+    max_size MB, the least recently used wheels being removed first.
+
+    {"<base slug>": {"<requirements sha256>": ["<wheel>", ...]}}
+    """
+
+    def __init__(self, path, max_size=WHEELHOUSE_SIZE):
+        self.path = path
+        self.max_size = max_size * 1024 * 1024
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.errors = {}
+        self.pruned = 0
+        self.index_path = join(path, 'index.json')
+        self.index = load_json(self.index_path, "Wheelhouse index", {})
+
+    def directory(self, base):
+        return join(self.path, slug(base))
+
+    def wheels(self, worker_dir, base):
+        """
+        Wheels of the wheelhouse of base sent to the build of the worker,
+        sorted.
+        """
+        wheels = self.directory(base)
+        if not isdir(wheels):
+            return []
+        available = sorted(entry.name for entry in scandir(wheels) if entry.name.endswith('.whl'))
+        known = self.index.get(slug(base), {}).get(requirements_hash(worker_dir))
+        if known is not None:
+            return [wheel for wheel in available if wheel in known]
+        projects = {project(requirement) for requirement in parse_requirements(worker_dir)}
+        return [wheel for wheel in available if wheel_project(wheel) in projects]
+
+    def context(self, worker_dir, base, dockerfile, build_context=None):
+        """
+        Build context (uncompressed tar file) with the worker directory (or
+        only the files of the minimal build_context), the wheels of the
+        worker from the wheelhouse of the base image and the generated
+        Dockerfile.
+        """
+        context = tempfile.TemporaryFile()
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            if build_context is None:
+                tar.add(worker_dir, arcname=CONTEXT_WORKER)
+            else:
+                build_context.add(tar, CONTEXT_WORKER)
+            info = tarfile.TarInfo(CONTEXT_WHEELHOUSE)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            with self.lock:
+                wheels = self.wheels(worker_dir, base)
+                for wheel in wheels:
+                    # last use: not pruned while added below
+                    utime(join(self.directory(base), wheel))
+            for wheel in wheels:
+                try:
+                    tar.add(join(self.directory(base), wheel), arcname='{}/{}'.format(CONTEXT_WHEELHOUSE, wheel))
+                except FileNotFoundError:
+                    # pruned anyway: built again by pip
+                    pass
+            data = dockerfile.encode('utf-8')
+            info = tarfile.TarInfo('Dockerfile')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        context.seek(0)
+        return context
+
+    def collect(self, client, image_tag, base, worker_dir):
+        """
+        Copy the compiled wheels built in the wheels stage of image_tag to
+        the wheelhouse of the base image, and remember them as the wheels of
+        the requirements of the worker.
+        """
+        wheels = self.directory(base)
+        makedirs(wheels, exist_ok=True)
+        compiled = []
+        container = client.containers.create(image_tag, entrypoint='true')
+        try:
+            stream, stat = container.get_archive('/wheels')
+            with tempfile.TemporaryFile() as archive:
+                for chunk in stream:
+                    archive.write(chunk)
+                archive.seek(0)
+                with tarfile.open(fileobj=archive) as tar:
+                    for member in tar.getmembers():
+                        name = basename(member.name)
+                        if not member.isfile() or not name.endswith('.whl') or name.endswith('-none-any.whl'):
+                            continue
+                        compiled.append(name)
+                        if isfile(join(wheels, name)):
+                            continue
+                        # builds running in parallel may add the same wheel
+                        with tempfile.NamedTemporaryFile(dir=wheels, suffix='.tmp', delete=False) as wheel:
+                            wheel.write(tar.extractfile(member).read())
+                        replace(wheel.name, join(wheels, name))
+                        print('Wheel {} added to the wheelhouse'.format(name))
+        finally:
+            container.remove(force=True)
+        with self.lock:
+            self.index.setdefault(slug(base), {})[requirements_hash(worker_dir)] = sorted(compiled)
+            self.prune(base)
+            self.save()
+
+    def prune(self, base):
+        """
+        Remove the old versions of each project, then the least recently
+        used wheels while the wheelhouse of base is over max_size. Wheels
+        used in the last PRUNE_GRACE seconds may be in a build context being
+        written: they are kept. Called with the lock held.
+        """
+        entries = sorted((entry for entry in scandir(self.directory(base)) if entry.name.endswith('.whl')),
+                         key=lambda entry: entry.stat().st_mtime, reverse=True)
+        recent = time.time() - PRUNE_GRACE
+        versions = {}
+        kept = []
+        for entry in entries:
+            versions[wheel_project(entry.name)] = versions.get(wheel_project(entry.name), 0) + 1
+            if versions[wheel_project(entry.name)] > WHEEL_VERSIONS and entry.stat().st_mtime < recent:
+                remove(entry.path)
+                self.pruned += 1
+            else:
+                kept.append(entry)
+        size = sum(entry.stat().st_size for entry in kept)
+        while kept and size > self.max_size and kept[-1].stat().st_mtime < recent:
+            entry = kept.pop()
+            size -= entry.stat().st_size
+            remove(entry.path)
+            self.pruned += 1
+
+    def save(self):
+        save_json(self.index_path, self.index)
+
+    def record(self, worker, lines):
+        """
+        Count, from the pip output of a build, the compiled wheels found in
+        the wheelhouse (hits) and the ones built from source (misses).
+        """
+        hits = sum(1 for line in lines if re.search(r'Processing /{}/\S+\.whl'.format(CONTEXT_WHEELHOUSE), line))
+        misses = sum(1 for line in lines if 'Building wheel for ' in line)
+        with self.lock:
+            self.stats[worker] = (hits, misses)
+
+    def failed(self, worker, error):
+        """
+        Record a failed update of the wheelhouse after a build of worker.
+        """
+        with self.lock:
+            self.errors[worker] = str(error)
+
+    def report(self):
+        for worker, (hits, misses) in sorted(self.stats.items()):
+            if hits + misses:
+                print('Wheelhouse {}: {} hits, {} misses ({:.0%})'.format(worker, hits, misses, hits / (hits + misses)))
+            else:
+                print('Wheelhouse {}: no compiled wheel'.format(worker))
+        for worker, error in sorted(self.errors.items()):
+            print('Wheelhouse {}: update failed: {}'.format(worker, error))
+        if self.pruned:
+            print('Wheelhouse: {} wheels removed'.format(self.pruned))